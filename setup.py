@@ -22,6 +22,9 @@ setup(
     install_requires=[
         "invoke>=1.1.1"
     ],
+    extras_require={
+        'chunked': ['cryptography'],
+    },
     zip_safe=False,
     include_package_data=True,  # see MANIFEST.in
     classifiers=[
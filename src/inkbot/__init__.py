@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from .api import (  # noqa
+    Backup,
+    BackupError,
+    CommandFailed,
+    ConfigError,
+    Event,
+    Fleet,
+    InkbotError,
+    ReleaseError,
+    Restore,
+    Runner,
+    TerraformError,
+    iter_events,
+)
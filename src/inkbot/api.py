@@ -0,0 +1,1460 @@
+# -*- coding: utf-8 -*-
+'''
+Inkbot library, backup, restore and provision darknodes without going
+through the command line
+
+Long running methods take an optional ``progress`` callable that receives
+:class:`Event` objects, use :func:`iter_events` to iterate over them instead.
+Errors are raised as :class:`InkbotError` subclasses.
+'''
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from glob import glob
+from os import path as osp
+from subprocess import list2cmdline
+from urllib.error import URLError
+from urllib.request import urlopen
+from . import chunked
+import fcntl
+import getpass
+import hashlib
+import io
+import json
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import stat
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+
+home_dir = osp.expanduser('~')
+real_darknode_dir = osp.join(home_dir, '.darknode')
+test_darknode_dir = real_darknode_dir + '-test'
+test = False  # set to True to darknode dir in ~/.darknode-test
+darknode_dir = test_darknode_dir if test else real_darknode_dir
+darknode_dir_var = '{{ darknode_dir }}'
+session_key_ttl = 600  # seconds a decrypted session key stays in the keyring
+install_script_url = 'https://releases.republicprotocol.com/darknode-cli/install.sh'
+default_jobs = 4  # concurrent terraform runs, they mostly wait on the network
+
+
+class InkbotError(Exception):
+    pass
+
+
+class ConfigError(InkbotError):
+    pass
+
+
+class ReleaseError(InkbotError):
+    pass
+
+
+class BackupError(InkbotError):
+    pass
+
+
+class CommandFailed(InkbotError):
+    def __init__(self, cmdline, exit_code, output=None):
+        msg = 'Command {!r} failed with exit code {!r}'.format(cmdline, exit_code)
+        super(CommandFailed, self).__init__(msg)
+        self.cmdline = cmdline
+        self.exit_code = exit_code
+        self.output = output
+
+
+class TerraformError(InkbotError):
+    def __init__(self, dirname, error, command='init'):
+        msg = "'terraform {}' failed in {!r}: {}".format(command, dirname, error)
+        super(TerraformError, self).__init__(msg)
+        self.dirname = dirname
+
+
+class Event(namedtuple('Event', ['kind', 'message', 'node'])):
+    '''
+    Progress event, kind is one of 'info', 'node', 'gpg' and 'warning', node
+    is the darknode name if the event is about a single darknode
+    '''
+    def __new__(cls, kind, message, node=None):
+        return super(Event, cls).__new__(cls, kind, message, node)
+
+
+BackupResult = namedtuple('BackupResult', ['backup_file', 'nodes'])
+RestoreResult = namedtuple('RestoreResult', ['nodes', 'extra_nodes'])
+ManifestEntry = namedtuple('ManifestEntry', ['size', 'sha256'])
+NodeDiff = namedtuple('NodeDiff', ['added', 'removed', 'modified'])
+DriftResult = namedtuple('DriftResult', ['dirname', 'node', 'drifted', 'summary', 'changes', 'cached'])
+CatalogFile = namedtuple('CatalogFile', ['backup_file', 'created', 'path', 'node', 'size', 'sha256'])
+
+
+def iter_events(func, *args, **kwargs):
+    '''
+    Call func(*args, progress=..., **kwargs) in a thread and yield its
+    events, the generator returns what func returns and raises what it raises
+    '''
+    events = queue.Queue()
+    done = object()
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = func(*args, progress=events.put, **kwargs)
+        except BaseException as e:
+            outcome['error'] = e
+        finally:
+            events.put(done)
+
+    threading.Thread(target=target, daemon=True).start()
+
+    while True:
+        event = events.get()
+
+        if event is done:
+            break
+
+        yield event
+
+    if 'error' in outcome:
+        raise outcome['error']
+
+    return outcome.get('result')
+
+
+def notify(progress, kind, message, node=None):
+    if progress:
+        progress(Event(kind, message, node))
+
+
+class Runner(object):
+    '''
+    Runs shell commands, capturing their output, subclass it to change how
+    commands are run
+
+    parallel is set when other commands may be running at the same time and
+    quiet when the caller only wants the output returned, not shown. env
+    holds extra environment variables for the command.
+    '''
+    def run(self, cmdline, cwd=None, parallel=False, quiet=False, env=None):
+        # Keep fds open for --passphrase-fd
+        proc = subprocess.Popen(cmdline, shell=True, cwd=cwd, close_fds=False,
+                                env=dict(os.environ, **env) if env else None,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = proc.communicate()
+        output = output.decode(errors='replace')
+
+        if proc.returncode:
+            raise CommandFailed(cmdline, proc.returncode, output)
+
+        return output
+
+
+class Fleet(object):
+    '''
+    Darknodes in a darknode directory, ~/.darknode by default
+    '''
+    def __init__(self, darknode_dir=None, runner=None):
+        self.darknode_dir = darknode_dir or globals()['darknode_dir']
+        self.runner = runner or Runner()
+        self.held_locks = threading.local()
+
+    @property
+    def inkbot_dir(self):
+        return osp.join(self.darknode_dir, 'inkbot')
+
+    @property
+    def bin_dir(self):
+        return osp.join(self.darknode_dir, 'bin')
+
+    @property
+    def darknodes_dir(self):
+        return osp.join(self.darknode_dir, 'darknodes')
+
+    @property
+    def release_cache_dir(self):
+        return osp.join(self.inkbot_dir, 'releases')
+
+    @property
+    def cache_dir(self):
+        return osp.join(self.inkbot_dir, 'cache')
+
+    @property
+    def catalog(self):
+        return Catalog(osp.join(self.inkbot_dir, 'catalog.sqlite'))
+
+    @property
+    def lock_dir(self):
+        return osp.join(self.inkbot_dir, 'locks')
+
+    @contextmanager
+    def lock(self, name, exclusive=True):
+        '''
+        Hold a flock() on inkbot/locks/<name>.lock, nested calls in the same
+        thread reuse the lock already held
+        '''
+        held = self.held_locks.__dict__.setdefault('held', {})
+
+        if name in held:
+            if exclusive and not held[name]:
+                raise InkbotError("Can't upgrade shared lock {!r} to exclusive".format(name))
+
+            yield
+            return
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        fd = os.open(osp.join(self.lock_dir, name + '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            held[name] = exclusive
+
+            try:
+                yield
+            finally:
+                del held[name]
+        finally:
+            os.close(fd)  # releases the flock
+
+    def tree_lock(self, exclusive=False):
+        '''
+        Whole darknode dir lock, shared by everything that touches it and
+        held exclusively by restore
+        '''
+        return self.lock('tree', exclusive)
+
+    @contextmanager
+    def node_lock(self, name, exclusive=True):
+        '''
+        Lock darknodes/<name>, or files outside darknodes/ if name is None
+        '''
+        with self.tree_lock(), self.lock('node-' + name if name else 'top-level', exclusive):
+            yield
+
+    def bin(self, name='darknode'):
+        if self.bin_dir in os.environ['PATH'].split(os.pathsep):
+            return name
+
+        return osp.join(self.bin_dir, name)
+
+    def nodes(self):
+        if not osp.isdir(self.darknodes_dir):
+            return []
+
+        return sorted(os.listdir(self.darknodes_dir))
+
+    def aws_keys(self):
+        try:
+            config = read_json_file(osp.join(self.inkbot_dir, 'aws.json'))
+        except FileNotFoundError:
+            raise ConfigError("AWS keys not found, please run 'inkbot set-aws-keys' to set them")
+
+        access_key = config.get('accessKey')
+
+        if not access_key:
+            raise ConfigError("AWS access key not found, please run 'inkbot set-aws-keys' to set it")
+
+        secret_key = config.get('secretKey')
+
+        if not secret_key:
+            raise ConfigError("AWS secret key not found, please run 'inkbot set-aws-keys' to set it")
+
+        return access_key, secret_key
+
+    def set_aws_keys(self, access_key, secret_key):
+        filename = osp.join(self.inkbot_dir, 'aws.json')
+        write_json_file(filename, {
+            'accessKey': access_key,
+            'secretKey': secret_key,
+        })
+        return filename
+
+    def do_token(self):
+        error = ConfigError("DO token not found, please run 'inkbot set-do-token' to set it")
+
+        try:
+            config = read_json_file(osp.join(self.inkbot_dir, 'do.json'))
+        except FileNotFoundError:
+            raise error
+
+        token = config.get('token')
+
+        if not token:
+            raise error
+
+        return token
+
+    def set_do_token(self, token):
+        filename = osp.join(self.inkbot_dir, 'do.json')
+        write_json_file(filename, {'token': token})
+        return filename
+
+    def aws_node_command(self, name, network=None, region=None, instance=None,
+                         access_key='$(inkbot aws-access-key)',
+                         secret_key='$(inkbot aws-secret-key)'):
+        # Credentials are substituted by the shell so they don't end up in
+        # shell history
+        cmd = self.up_command(name, network) + [
+            '--aws',
+            '--aws-access-key', access_key,
+            '--aws-secret-key', secret_key,
+        ]
+
+        if region:
+            cmd += ['--aws-region', region]
+
+        if instance:
+            cmd += ['--aws-instance', instance]
+
+        return list2cmdline(cmd)
+
+    def do_node_command(self, name, network=None, region=None, droplet=None,
+                        token='$(inkbot do-token)'):
+        cmd = self.up_command(name, network) + [
+            '--do',
+            '--do-token', token,
+        ]
+
+        if region:
+            cmd += ['--do-region', region]
+
+        if droplet:
+            cmd += ['--do-droplet', droplet]
+
+        return list2cmdline(cmd)
+
+    def up_command(self, name, network=None):
+        cmd = [
+            self.bin(), 'up',
+            '--name', name,
+        ]
+
+        if network:
+            cmd += ['--network', network]
+
+        return cmd
+
+    def add_aws_node(self, name, network=None, region=None, instance=None, progress=None):
+        # Pass credentials of this fleet in the environment, 'inkbot
+        # aws-access-key' would read the default darknode dir
+        access_key, secret_key = self.aws_keys()
+        cmdline = self.aws_node_command(name, network, region, instance,
+                                        '$INKBOT_AWS_ACCESS_KEY', '$INKBOT_AWS_SECRET_KEY')
+
+        with self.node_lock(name):
+            self.install_darknode_cli(progress=progress)
+            self.runner.run(cmdline, env={
+                'INKBOT_AWS_ACCESS_KEY': access_key,
+                'INKBOT_AWS_SECRET_KEY': secret_key,
+            })
+
+    def add_do_node(self, name, network=None, region=None, droplet=None, progress=None):
+        cmdline = self.do_node_command(name, network, region, droplet, '$INKBOT_DO_TOKEN')
+
+        with self.node_lock(name):
+            self.install_darknode_cli(progress=progress)
+            self.runner.run(cmdline, env={'INKBOT_DO_TOKEN': self.do_token()})
+
+    def install_darknode_cli(self, update=False, version=None, progress=None):
+        '''
+        Install darknode-cli from the release cache if not already
+        installed, returns the installed version or None if nothing was done
+
+        Without version or update the pinned version is installed, it is
+        never replaced by another version behind the caller's back.
+        '''
+        with self.tree_lock(), self.lock('darknode-cli'):
+            if not (version or update or not osp.exists(self.bin_dir)):
+                return None
+
+            if update:
+                version = self.prefetch_darknode_cli(progress=progress)
+            elif version:
+                if not osp.exists(self.release_archive(version)):
+                    raise ReleaseError(("darknode-cli {0} is not cached, please run"
+                                        " 'inkbot prefetch-darknode-cli --version {0}'"
+                                        " to fetch it".format(version)))
+            else:
+                version = self.pinned_release().get('version')
+
+                if not version:
+                    version = self.prefetch_darknode_cli(progress=progress)
+                elif not osp.exists(self.release_archive(version)):
+                    raise ReleaseError(("darknode-cli {0} is pinned but not cached, please run"
+                                        " 'inkbot prefetch-darknode-cli --version {0}'"
+                                        " to fetch it".format(version)))
+
+            self.install_release(version, progress)
+            return version
+
+    def prefetch_darknode_cli(self, version=None, progress=None):
+        '''
+        Fetch a darknode-cli release, the latest if version is None, into the
+        release cache and return its version
+
+        If INKBOT_RELEASE_URL is set the release is downloaded from that
+        mirror and verified against the checksum published next to it.
+        Otherwise the latest release is installed with the upstream install
+        script and repacked reproducibly, its checksum is pinned on first
+        install. Either way a pinned release must match its pinned checksum.
+        '''
+        mirror_url = os.environ.get('INKBOT_RELEASE_URL')
+        os.makedirs(self.release_cache_dir, exist_ok=True)
+        fd, temp_file = tempfile.mkstemp(prefix='.download-', dir=self.release_cache_dir)
+        os.close(fd)
+
+        try:
+            if mirror_url:
+                version, expected = self.download_release(mirror_url, version, temp_file)
+            else:
+                version, expected = self.run_install_script(version, temp_file)
+
+            checksum = file_sha256(temp_file)
+
+            if expected and checksum != expected:
+                raise ReleaseError('Checksum mismatch for darknode-cli {}: expected {}, got {}'.format(
+                    version, expected, checksum))
+
+            archive_file = self.release_archive(version)
+            os.replace(temp_file, archive_file)
+        except BaseException:
+            if osp.exists(temp_file):
+                os.unlink(temp_file)
+
+            raise
+
+        with open(archive_file + '.sha256', 'w') as fobj:
+            fobj.write('{}  {}\n'.format(checksum, osp.basename(archive_file)))
+
+        notify(progress, 'info', 'Cached darknode-cli {} in {!r}'.format(version, self.release_cache_dir))
+        return version
+
+    def download_release(self, mirror_url, version, archive_file):
+        # Mirror layout: latest, <version>/darknode-cli.tgz and
+        # <version>/darknode-cli.tgz.sha256
+        if not version:
+            version = fetch_url('{}/latest'.format(mirror_url)).decode().strip()
+
+            if not re.match(r'^[\w.+-]+$', version):
+                raise ReleaseError('Invalid latest darknode-cli version {!r}'.format(version))
+
+        url = '{}/{}/darknode-cli.tgz'.format(mirror_url, version)
+        expected = self.pinned_checksum(version) or fetch_url(url + '.sha256').decode().split()[0]
+
+        with open(archive_file, 'wb') as fobj:
+            fobj.write(fetch_url(url))
+
+        return version, expected
+
+    def run_install_script(self, version, archive_file):
+        with new_temp_dir() as temp_home:
+            # Let the install script install into a throwaway home
+            self.runner.run('curl {} -sSf | HOME={} sh'.format(
+                list2cmdline([install_script_url]), list2cmdline([temp_home])))
+            home_darknode_dir = osp.join(temp_home, '.darknode')
+            bin_dir = osp.join(home_darknode_dir, 'bin')
+
+            if not osp.isdir(bin_dir):
+                raise ReleaseError('darknode-cli install script did not create {!r}'.format(bin_dir))
+
+            latest = release_version(bin_dir)
+
+            if not latest:
+                raise ReleaseError('Failed to get the version of darknode-cli from {!r}'.format(bin_dir))
+
+            if version and version != latest:
+                raise ReleaseError(("darknode-cli {} can't be fetched, the install script only installs"
+                                    " the latest release {}, set INKBOT_RELEASE_URL to a release"
+                                    " mirror to fetch other releases".format(version, latest)))
+
+            # The same files always give the same archive, so that the
+            # checksum can be pinned
+            self.runner.run('{} | gzip -n > {}'.format(
+                list2cmdline(['tar', '--sort=name', '--mtime=@0', '--owner=0', '--group=0',
+                              '--numeric-owner', '-C', home_darknode_dir, '-cf', '-', 'bin']),
+                list2cmdline([archive_file])))
+
+        return latest, self.pinned_checksum(latest)
+
+    def release_archive(self, version):
+        return osp.join(self.release_cache_dir, 'darknode-cli-{}.tgz'.format(version))
+
+    def pinned_checksum(self, version):
+        pinned = self.pinned_release()
+        return pinned.get('sha256') if pinned.get('version') == version else None
+
+    def pinned_release(self):
+        '''
+        Return {'version': ..., 'sha256': ...} of the installed release, or {}
+        '''
+        try:
+            return read_json_file(osp.join(self.inkbot_dir, 'darknode-cli.json'))
+        except FileNotFoundError:
+            return {}
+
+    def install_release(self, version, progress=None):
+        archive_file = self.release_archive(version)
+
+        try:
+            with open(archive_file + '.sha256') as fobj:
+                expected = fobj.read().split()[0]
+        except (FileNotFoundError, IndexError):
+            raise ReleaseError(("Checksum of {!r} not found, please run"
+                                " 'inkbot prefetch-darknode-cli --version {}'".format(archive_file, version)))
+
+        pinned = self.pinned_checksum(version)
+
+        if pinned and pinned != expected:
+            raise ReleaseError('Cached {!r} does not match the pinned checksum {}'.format(
+                archive_file, pinned))
+
+        if file_sha256(archive_file) != expected:
+            raise ReleaseError('Checksum mismatch for {!r}, please prefetch it again'.format(archive_file))
+
+        notify(progress, 'info', 'Installing darknode-cli {} from {!r}'.format(version, archive_file))
+        os.makedirs(self.darknode_dir, exist_ok=True)
+        self.runner.run(list2cmdline(['tar', '-C', self.darknode_dir, '-xzf', archive_file]))
+        write_json_file(osp.join(self.inkbot_dir, 'darknode-cli.json'), {
+            'version': version,
+            'sha256': expected,
+        })
+
+    def manifest(self, excludes=None):
+        '''
+        Return {path: ManifestEntry} of files that would be backed up, hashes
+        of files whose size and mtime haven't changed are read from cache
+        '''
+        if excludes is None:
+            excludes = Backup.excludes
+
+        cache_file = osp.join(self.cache_dir, 'hashes.json')
+
+        try:
+            cache = read_json_file(cache_file)
+        except (FileNotFoundError, ConfigError):
+            cache = {}
+
+        manifest = {}
+        new_cache = {}
+
+        for path, filename, st in walk_files(self.darknode_dir, excludes):
+            cached = cache.get(path)
+
+            if cached and cached[:2] == [st.st_size, st.st_mtime_ns]:
+                digest = cached[2]
+            else:
+                digest = file_sha256(filename)
+
+            new_cache[path] = [st.st_size, st.st_mtime_ns, digest]
+            manifest[path] = ManifestEntry(st.st_size, digest)
+
+        if new_cache != cache:
+            write_json_file(cache_file, new_cache)
+
+        return manifest
+
+    def terraform_dirs(self):
+        dirs = [self.darknode_dir]
+        dirs += [osp.join(self.darknodes_dir, name) for name in self.nodes()]
+        return [d for d in dirs if glob(osp.join(d, '*.tf'))]
+
+    def terraform_init(self, force=False, jobs=None, progress=None):
+        '''
+        Run 'terraform init' in darknode directories concurrently
+        '''
+        def init(dirname):
+            with self.node_lock(self.node_of_dir(dirname)):
+                self.init_terraform_dir(dirname, force, progress)
+
+        with self.tree_lock(), ThreadPoolExecutor(max_workers=num_jobs(jobs)) as pool:
+            wait_all([pool.submit(init, dirname) for dirname in self.terraform_dirs()])
+
+    def init_terraform_dir(self, dirname, force=False, progress=None):
+        if not glob(osp.join(dirname, '*.tf')):
+            return
+
+        if force or not osp.exists(osp.join(dirname, '.terraform')):
+            cmdline = list2cmdline([self.bin('terraform'), 'init'])
+
+            try:
+                self.runner.run(cmdline, cwd=dirname, parallel=True)
+            except CommandFailed as e:
+                raise TerraformError(dirname, e)
+
+            notify(progress, 'node', "Ran 'terraform init' in {!r}".format(dirname),
+                   self.node_of_dir(dirname))
+
+    def drift(self, force=False, jobs=None, progress=None):
+        '''
+        Run 'terraform plan' concurrently in darknode directories and return
+        a DriftResult for each, directories whose .tf files and state haven't
+        changed since the last plan are skipped unless force is set
+        '''
+        cache_file = osp.join(self.cache_dir, 'drift.json')
+
+        try:
+            cache = read_json_file(cache_file)
+        except (FileNotFoundError, ConfigError):
+            cache = {}
+
+        def check(dirname):
+            digest = terraform_digest(dirname)
+            cached = cache.get(dirname)
+
+            if not force and cached and cached['digest'] == digest:
+                return DriftResult(dirname, self.node_of_dir(dirname), cached['drifted'],
+                                   cached['summary'], cached['changes'], True)
+
+            with self.node_lock(self.node_of_dir(dirname)):
+                result = self.plan_terraform_dir(dirname, progress)
+
+            if result.drifted is not None:
+                cache[dirname] = {
+                    'digest': digest,
+                    'drifted': result.drifted,
+                    'summary': result.summary,
+                    'changes': result.changes,
+                }
+
+            return result
+
+        with self.tree_lock(), ThreadPoolExecutor(max_workers=num_jobs(jobs)) as pool:
+            futures = [pool.submit(check, dirname) for dirname in self.terraform_dirs()]
+            wait_all(futures)
+
+        write_json_file(cache_file, cache)
+        return [f.result() for f in futures]
+
+    def plan_terraform_dir(self, dirname, progress=None):
+        node = self.node_of_dir(dirname)
+        self.init_terraform_dir(dirname, progress=progress)
+        cmdline = list2cmdline([self.bin('terraform'), 'plan', '-detailed-exitcode',
+                                '-input=false', '-lock=false', '-no-color'])
+
+        try:
+            output = self.runner.run(cmdline, cwd=dirname, parallel=True, quiet=True)
+            exit_code = 0
+        except CommandFailed as e:
+            output = e.output or ''
+            exit_code = e.exit_code
+
+        if exit_code not in (0, 2):
+            error = TerraformError(dirname, 'exit code {}'.format(exit_code), 'plan')
+            notify(progress, 'warning', str(error), node)
+            return DriftResult(dirname, node, None, str(error), [], False)
+
+        match = re.search(r'^Plan: .*$', output, re.M)
+        changes = re.findall(r'^\s*# (\S+ (?:will|must) be .*)$', output, re.M)
+
+        if exit_code == 0:
+            summary = 'No changes'
+        else:
+            summary = match.group(0) if match else 'Changes'
+
+        notify(progress, 'node', "Ran 'terraform plan' in {!r}: {}".format(dirname, summary), node)
+        return DriftResult(dirname, node, exit_code == 2, summary, changes, False)
+
+    def node_of_dir(self, dirname):
+        if osp.dirname(osp.normpath(dirname)) == osp.normpath(self.darknodes_dir):
+            return osp.basename(osp.normpath(dirname))
+
+        return None
+
+
+class Backup(object):
+    '''
+    Backup darknodes and credentials into an encrypted archive
+    '''
+    excludes = [
+        '.terraform',
+        '/bin/',
+        '/darknode-setup',
+        '/gen-config',
+        '/inkbot/releases/',
+        '/inkbot/darknode-cli.json',  # pins the release installed on this machine
+        '/inkbot/cache/',
+        '/inkbot/catalog.sqlite',
+        '/inkbot/locks/',
+    ]
+
+    def __init__(self, fleet=None, passphrase_fd=None, use_chunked=False, jobs=None):
+        self.fleet = fleet or Fleet()
+        self.passphrase_fd = passphrase_fd
+        self.use_chunked = use_chunked  # encrypt with inkbot.chunked instead of gpg
+        self.jobs = jobs
+
+    def run(self, dest, progress=None):
+        '''
+        Backup to dest, a file name or a binary file object
+        '''
+        fleet = self.fleet
+
+        if isinstance(dest, str) and not osp.isdir(osp.dirname(osp.abspath(dest))):
+            raise BackupError('Directory of backup file {!r} does not exist'.format(dest))
+
+        with new_temp_dir() as backup_dir, new_temp_dir() as temp_dir:
+            self.snapshot(backup_dir)
+            # Catalog files as they are restored, before the placeholder
+            # substitution below, both skip the same top level dotfiles
+            manifest = dir_manifest(backup_dir)
+            search_replace_tf(backup_dir, re.escape(fleet.darknode_dir), darknode_dir_var, progress)
+            archive_file = osp.join(temp_dir, 'backup.tgz')
+            fleet.runner.run(list2cmdline(['tar', '-czf', archive_file, '--'] + archive_names(backup_dir)),
+                             cwd=backup_dir)
+
+            if isinstance(dest, str):
+                encrypt(fleet.runner, archive_file, dest, self.passphrase_fd,
+                        self.use_chunked, self.jobs)
+            else:
+                cipher_file = osp.join(temp_dir, 'backup.tgz.gpg')
+                encrypt(fleet.runner, archive_file, cipher_file, self.passphrase_fd,
+                        self.use_chunked, self.jobs)
+
+                with open(cipher_file, 'rb') as fobj:
+                    shutil.copyfileobj(fobj, dest)
+
+            nodes = sorted(os.listdir(osp.join(backup_dir, 'darknodes'))) \
+                if osp.isdir(osp.join(backup_dir, 'darknodes')) else []
+
+        backup_file = osp.abspath(dest) if isinstance(dest, str) else getattr(dest, 'name', None)
+        fleet.catalog.add(backup_file, manifest)
+        notify(progress, 'info', 'Recorded {} files in catalog {!r}'.format(
+            len(manifest), fleet.catalog.filename))
+        return BackupResult(backup_file, nodes)
+
+    def snapshot(self, backup_dir):
+        # Copy darknodes one at a time while holding their locks, so each is
+        # consistent without stopping work on the others
+        fleet = self.fleet
+
+        with fleet.tree_lock():
+            with fleet.node_lock(None, exclusive=False):
+                rsync(fleet.runner, fleet.darknode_dir, backup_dir, self.excludes + ['/darknodes/*'])
+
+            node_excludes = [e for e in self.excludes if not e.startswith('/')]
+
+            for name in fleet.nodes():
+                with fleet.node_lock(name, exclusive=False):
+                    rsync(fleet.runner, osp.join(fleet.darknodes_dir, name),
+                          osp.join(backup_dir, 'darknodes', name), node_excludes)
+
+
+class Catalog(object):
+    '''
+    SQLite catalog of backup manifests, to find backups without decrypting them
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+
+    @contextmanager
+    def connect(self):
+        os.makedirs(osp.dirname(self.filename), exist_ok=True)
+
+        with closing(sqlite3.connect(self.filename)) as conn:
+            with conn:
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS backups (
+                        id INTEGER PRIMARY KEY,
+                        backup_file TEXT,
+                        created TEXT NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS files (
+                        backup_id INTEGER NOT NULL REFERENCES backups(id),
+                        path TEXT NOT NULL,
+                        node TEXT,
+                        size INTEGER NOT NULL,
+                        sha256 TEXT NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS files_path ON files(path);
+                    CREATE INDEX IF NOT EXISTS files_node ON files(node);
+                ''')
+                yield conn
+
+    def add(self, backup_file, manifest, created=None):
+        '''
+        Record manifest of backup_file, a {path: ManifestEntry} dict
+        '''
+        if created is None:
+            created = time.strftime('%Y-%m-%d %H:%M:%S')
+
+        with self.connect() as conn:
+            if backup_file:
+                # Re-cataloging a file replaces its previous manifest
+                ids = [row[0] for row in conn.execute(
+                    'SELECT id FROM backups WHERE backup_file = ?', (backup_file,))]
+                conn.executemany('DELETE FROM files WHERE backup_id = ?', [(i,) for i in ids])
+                conn.executemany('DELETE FROM backups WHERE id = ?', [(i,) for i in ids])
+
+            backup_id = conn.execute('INSERT INTO backups (backup_file, created) VALUES (?, ?)',
+                                     (backup_file, created)).lastrowid
+            conn.executemany(
+                'INSERT INTO files (backup_id, path, node, size, sha256) VALUES (?, ?, ?, ?, ?)',
+                [(backup_id, path, member_node(path), entry.size, entry.sha256)
+                 for path, entry in sorted(manifest.items())])
+
+    def find(self, query):
+        '''
+        Return CatalogFile of files whose darknode name is query, whose path
+        is query or ends with /query, newest backups first
+        '''
+        with self.connect() as conn:
+            rows = conn.execute('''
+                SELECT b.backup_file, b.created, f.path, f.node, f.size, f.sha256
+                FROM files f JOIN backups b ON f.backup_id = b.id
+                WHERE f.node = ? OR f.path = ? OR f.path LIKE ? ESCAPE '\\'
+                ORDER BY b.created DESC, b.id DESC, f.path
+            ''', (query, query, '%/' + like_escape(query)))
+            return [CatalogFile(*row) for row in rows]
+
+
+class Restore(object):
+    '''
+    Restore and inspect backups made by :class:`Backup`
+    '''
+    def __init__(self, fleet=None, passphrase_fd=None, no_cache=False):
+        self.fleet = fleet or Fleet()
+        self.passphrase_fd = passphrase_fd
+        self.no_cache = no_cache
+
+    def run(self, source, jobs=None, progress=None):
+        '''
+        Restore from source, a file name or a binary file object
+
+        Each darknode is restored and has its 'terraform init' started as
+        soon as it has been extracted, while the rest of the archive keeps
+        streaming.
+        '''
+        fleet = self.fleet
+        nodes = []
+
+        if isinstance(source, str):
+            check_backup_file(source)
+
+        with fleet.tree_lock(exclusive=True), new_temp_dir() as backup_dir, \
+                ThreadPoolExecutor(max_workers=num_jobs(jobs)) as pool:
+            fleet.install_darknode_cli(progress=progress)
+            # rsync only creates the last directory of the destination
+            os.makedirs(fleet.darknodes_dir, exist_ok=True)
+            futures = []
+
+            def node_extracted(name):
+                nodes.append(name)
+                node_dir = osp.join(backup_dir, 'darknodes', name)
+                search_replace_tf(node_dir, re.escape(darknode_dir_var), fleet.darknode_dir,
+                                  progress, nodes=False)
+                dest_dir = osp.join(fleet.darknodes_dir, name)
+                rsync(fleet.runner, node_dir, dest_dir)
+                notify(progress, 'node', 'Restored darknode {!r}'.format(name), name)
+                futures.append(pool.submit(fleet.init_terraform_dir, dest_dir, progress=progress))
+
+            self.extract(source, backup_dir, node_extracted, progress)
+            search_replace_tf(backup_dir, re.escape(darknode_dir_var), fleet.darknode_dir,
+                              progress, nodes=False)
+            # Darknodes were already restored and may be running terraform
+            # init, older backups may carry the release pin of another machine
+            rsync(fleet.runner, backup_dir, fleet.darknode_dir,
+                  ['/darknodes/', '/inkbot/darknode-cli.json'])
+            futures.append(pool.submit(fleet.init_terraform_dir, fleet.darknode_dir, progress=progress))
+            extra_nodes = sorted(set(fleet.nodes()).difference(nodes))
+            wait_all(futures)
+
+        return RestoreResult(sorted(nodes), extra_nodes)
+
+    def extract(self, source, dest_dir, node_extracted=None, progress=None):
+        '''
+        Decrypt and extract source into dest_dir without an intermediate
+        archive, calling node_extracted(name) whenever a darknodes/<name>
+        directory has been completely extracted
+        '''
+        extract_kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+        extracted_nodes = set()
+        state = {'node': None}
+
+        def finish_node():
+            node = state['node']
+
+            if node and node not in extracted_nodes:
+                extracted_nodes.add(node)
+
+                if node_extracted:
+                    node_extracted(node)
+
+        os.makedirs(dest_dir, exist_ok=True)
+
+        with self.open(source, progress) as tar:
+            for member in tar:
+                node = member_node(member.name)
+
+                if node != state['node']:
+                    finish_node()
+                    state['node'] = node
+
+                tar.extract(member, dest_dir, **extract_kwargs)
+
+        finish_node()
+
+    def manifest(self, source, progress=None):
+        '''
+        Return {path: ManifestEntry} of files inside the backup as they would
+        be restored, without extracting anything to disk
+        '''
+        manifest = {}
+
+        with self.open(source, progress) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+
+                path = osp.normpath(member.name)
+                fobj = tar.extractfile(member)
+
+                if is_tf_file(path):
+                    # Hash it as it would be after restore
+                    content = re.sub(re.escape(darknode_dir_var), self.fleet.darknode_dir,
+                                     fobj.read().decode()).encode()
+                    manifest[path] = ManifestEntry(len(content), hashlib.sha256(content).hexdigest())
+                else:
+                    manifest[path] = ManifestEntry(member.size, fileobj_sha256(fobj))
+
+        return manifest
+
+    def diff(self, source, progress=None):
+        '''
+        Compare the backup against the darknode dir, return {node: NodeDiff}
+        of nodes that differ, node is None for files outside darknodes/,
+        added files are only in the backup and removed files are only in the
+        darknode dir
+        '''
+        backup = self.manifest(source, progress)
+        live = self.fleet.manifest()
+        diffs = {}
+
+        def node_diff(path):
+            node = member_node(path)
+
+            if node not in diffs:
+                diffs[node] = NodeDiff([], [], [])
+
+            return diffs[node]
+
+        for path in sorted(set(backup).union(live)):
+            if path not in live:
+                node_diff(path).added.append(path)
+            elif path not in backup:
+                node_diff(path).removed.append(path)
+            elif backup[path] != live[path]:
+                node_diff(path).modified.append(path)
+
+        return diffs
+
+    def list(self, source, progress=None):
+        '''
+        Return tarfile.TarInfo of every file inside the backup
+        '''
+        with self.open(source, progress) as tar:
+            return list(tar)
+
+    @contextmanager
+    def open(self, source, progress=None):
+        '''
+        Yield the decrypted backup as a streaming tarfile.TarFile
+        '''
+        with backup_path(source) as cipher_file, \
+                decrypted_stream(cipher_file, self.passphrase_fd, self.no_cache, progress) as stream:
+            try:
+                with tarfile.open(fileobj=stream, mode='r|gz') as tar:
+                    yield tar
+            except tarfile.TarError as e:
+                raise BackupError('Failed to extract {!r}: {}'.format(cipher_file, e))
+
+
+def walk_files(root, excludes):
+    # Yields (path, filename, stat) of regular files under root that aren't
+    # excluded, path is relative to root
+    for dirpath, dirnames, filenames in os.walk(root):
+        reldir = osp.relpath(dirpath, root)
+        reldir = '' if reldir == '.' else reldir
+
+        if not reldir:
+            # Top level dotfiles aren't archived, see archive_names()
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            filenames = [f for f in filenames if not f.startswith('.')]
+
+        dirnames[:] = sorted(d for d in dirnames
+                             if not is_excluded(osp.join(reldir, d), True, excludes))
+
+        for name in sorted(filenames):
+            path = osp.join(reldir, name)
+            filename = osp.join(dirpath, name)
+            st = os.lstat(filename)
+
+            if stat.S_ISREG(st.st_mode) and not is_excluded(path, False, excludes):
+                yield path, filename, st
+
+
+def archive_names(dirname):
+    # Top level entries of dirname that go into the archive, like the shell
+    # glob '*' dotfiles are left out
+    return sorted(name for name in os.listdir(dirname) if not name.startswith('.'))
+
+
+def dir_manifest(root):
+    return {path: ManifestEntry(st.st_size, file_sha256(filename))
+            for path, filename, st in walk_files(root, [])}
+
+
+def terraform_digest(dirname):
+    # Changes whenever terraform configuration or state changes
+    digest = hashlib.sha256()
+
+    for filename in sorted(glob(osp.join(dirname, '*.tf'))) + [osp.join(dirname, 'terraform.tfstate')]:
+        if osp.exists(filename):
+            digest.update(osp.basename(filename).encode() + b'\0')
+            digest.update(file_sha256(filename).encode())
+
+    return digest.hexdigest()
+
+
+def is_tf_file(path):
+    # Only these have their paths rewritten, see search_replace_tf()
+    parts = path.split(os.sep)
+    return path.endswith('.tf') and (len(parts) == 1 or (len(parts) == 3 and parts[0] == 'darknodes'))
+
+
+def is_excluded(path, is_dir, excludes):
+    # Matches rsync exclude patterns as used in Backup.excludes: anchored to
+    # the top with a leading slash, directories only with a trailing slash
+    for pattern in excludes:
+        if pattern.endswith('/') and not is_dir:
+            continue
+
+        pattern = pattern.rstrip('/')
+
+        if pattern.startswith('/'):
+            if path == pattern[1:]:
+                return True
+        elif osp.basename(path) == pattern:
+            return True
+
+    return False
+
+
+def like_escape(text):
+    return re.sub(r'([\\%_])', r'\\\1', text)
+
+
+def member_node(member_name):
+    parts = osp.normpath(member_name).split(os.sep)
+    return parts[1] if len(parts) > 1 and parts[0] == 'darknodes' else None
+
+
+@contextmanager
+def backup_path(source):
+    # gpg needs a file name, spool file objects to a temp file
+    if isinstance(source, str):
+        check_backup_file(source)
+        yield source
+        return
+
+    with new_temp_dir() as temp_dir:
+        filename = osp.join(temp_dir, 'backup.gpg')
+
+        with open(filename, 'wb') as fobj:
+            shutil.copyfileobj(source, fobj)
+
+        yield filename
+
+
+def check_backup_file(filename):
+    try:
+        with open(filename, 'rb'):
+            pass
+    except OSError as e:
+        raise BackupError("Can't read backup file {!r}: {}".format(filename, e.strerror or e))
+
+
+@contextmanager
+def decrypted_stream(cipher_file, passphrase_fd=None, no_cache=False, progress=None):
+    if chunked.is_chunked(cipher_file):
+        with chunked_stream(cipher_file, passphrase_fd, no_cache) as stream:
+            yield stream
+
+        return
+
+    with gpg_decrypt_command(cipher_file, '-', passphrase_fd, no_cache, progress) as cmdline:
+        # Keep fds open for --passphrase-fd
+        proc = subprocess.Popen(cmdline, shell=True, stdout=subprocess.PIPE, close_fds=False)
+
+        try:
+            yield proc.stdout
+            proc.stdout.read()  # drain trailing padding
+        except BaseException:
+            # gpg fails once the pipe is closed, don't hide the real error
+            proc.kill()
+            proc.wait()
+            raise
+        finally:
+            proc.stdout.close()
+
+        if proc.wait():
+            raise BackupError('Failed to decrypt {!r}'.format(cipher_file))
+
+
+def encrypt(runner, plain_file, cipher_file, passphrase_fd=None, use_chunked=False, jobs=None):
+    if use_chunked:
+        passphrase = read_passphrase(passphrase_fd, confirm=True)
+
+        with open(plain_file, 'rb') as plain_fobj, open(cipher_file, 'wb') as cipher_fobj:
+            try:
+                key = chunked.encrypt(plain_fobj, cipher_fobj, passphrase,
+                                      jobs=num_jobs(jobs, chunked.default_jobs))
+            except chunked.ChunkedError as e:
+                raise BackupError(str(e))
+
+        # The key is known already, no need to derive it again to decrypt
+        keyring_write(session_key_name(cipher_file), key.hex(), session_key_ttl)
+        return
+
+    runner.run(list2cmdline([
+        'gpg', '--cipher-algo', 'AES256',
+        '-c',
+        '-o', cipher_file,
+    ] + passphrase_args(passphrase_fd) + [
+        plain_file
+    ]))
+
+
+def decrypt(runner, cipher_file, plain_file, passphrase_fd=None, no_cache=False, progress=None):
+    check_backup_file(cipher_file)
+
+    if chunked.is_chunked(cipher_file):
+        with chunked_stream(cipher_file, passphrase_fd, no_cache) as stream, \
+                open(plain_file, 'wb') as fobj:
+            shutil.copyfileobj(stream, fobj)
+
+        return
+
+    with gpg_decrypt_command(cipher_file, plain_file, passphrase_fd, no_cache, progress) as cmdline:
+        runner.run(cmdline)
+
+
+@contextmanager
+def chunked_stream(cipher_file, passphrase_fd=None, no_cache=False, jobs=None):
+    jobs = num_jobs(jobs, chunked.default_jobs)
+    key_name = session_key_name(cipher_file)
+    key = None if no_cache else keyring_read(key_name)
+
+    with open(cipher_file, 'rb') as fobj:
+        try:
+            if key:
+                reader = chunked.Reader(fobj, key=bytes.fromhex(key), jobs=jobs)
+            else:
+                reader = chunked.Reader(fobj, read_passphrase(passphrase_fd), jobs=jobs)
+
+            with io.BufferedReader(reader, reader.header.chunk_size) as stream:
+                yield stream
+        except chunked.ChunkedError as e:
+            raise BackupError('Failed to decrypt {!r}: {}'.format(cipher_file, e))
+
+    if not key and not no_cache:
+        keyring_write(key_name, reader.key.hex(), session_key_ttl)
+
+
+def read_passphrase(passphrase_fd=None, confirm=False):
+    if passphrase_fd is not None:
+        # Like gpg --passphrase-fd, read up to the first newline
+        passphrase = b''
+
+        while True:
+            char = os.read(int(passphrase_fd), 1)
+
+            if not char or char == b'\n':
+                return passphrase
+
+            passphrase += char
+
+    passphrase = getpass.getpass('Enter passphrase: ')
+
+    if confirm and getpass.getpass('Repeat passphrase: ') != passphrase:
+        raise BackupError("Passphrases don't match")
+
+    return passphrase.encode()
+
+
+@contextmanager
+def gpg_decrypt_command(cipher_file, plain_file, passphrase_fd=None, no_cache=False, progress=None):
+    # Yields the shell command line that decrypts <cipher-file> to
+    # <plain-file> ('-' for stdout), the session key is cached once the
+    # caller has run it successfully
+    key_name = session_key_name(cipher_file)
+    session_key = None if no_cache else keyring_read(key_name)
+
+    with new_temp_dir() as temp_dir:
+        cmd = ['gpg', '-o', plain_file]
+        redirects = []
+        status_file = osp.join(temp_dir, 'status')
+        stderr_file = osp.join(temp_dir, 'stderr')
+
+        if session_key:
+            # Pass the key through a file descriptor so that it doesn't show
+            # up in the echoed command or in the process list
+            key_file = osp.join(temp_dir, 'session-key')
+            write_private_file(key_file, session_key)
+            cmd += ['--override-session-key-fd', '3']
+            redirects += ['3<' + list2cmdline([key_file])]
+        else:
+            cmd += ['--show-session-key', '--status-file', status_file]
+            cmd += passphrase_args(passphrase_fd)
+
+        cmd.append(cipher_file)
+        # gpg also logs the session key to stderr, keep it out of the output
+        redirects += ['2>' + list2cmdline([stderr_file])]
+
+        try:
+            yield ' '.join([list2cmdline(cmd)] + redirects)
+        finally:
+            for line in gpg_messages(stderr_file):
+                notify(progress, 'gpg', line)
+
+        if not session_key and not no_cache:
+            session_key = read_session_key(status_file)
+
+            if session_key:
+                keyring_write(key_name, session_key, session_key_ttl)
+
+
+def forget_session_key(backup_file):
+    check_backup_file(backup_file)
+    keyring_clear(session_key_name(backup_file))
+
+
+def passphrase_args(passphrase_fd):
+    if passphrase_fd is None:
+        return []
+
+    passphrase_fd = int(passphrase_fd)
+    os.set_inheritable(passphrase_fd, True)
+    return [
+        '--batch',
+        '--pinentry-mode', 'loopback',
+        '--passphrase-fd', str(passphrase_fd),
+    ]
+
+
+def gpg_messages(stderr_file):
+    if not osp.exists(stderr_file):
+        return []
+
+    with open(stderr_file) as fobj:
+        return [line.rstrip('\n') for line in fobj
+                if 'session key' not in line and 'seskey' not in line]
+
+
+def read_session_key(status_file):
+    try:
+        with open(status_file) as fobj:
+            for line in fobj:
+                parts = line.split()
+
+                if parts[:2] == ['[GNUPG:]', 'SESSION_KEY'] and len(parts) > 2:
+                    return parts[2]
+    except FileNotFoundError:
+        pass
+
+    return None
+
+
+def session_key_name(backup_file):
+    # Leading bytes contain the random S2K salt, so the name changes whenever
+    # the backup is re-encrypted
+    digest = hashlib.sha256()
+
+    with open(backup_file, 'rb') as fobj:
+        digest.update(str(os.fstat(fobj.fileno()).st_size).encode())
+        digest.update(fobj.read(64 * 1024))
+
+    return 'inkbot:' + digest.hexdigest()[:32]
+
+
+def keyctl(args, input=None):
+    try:
+        proc = subprocess.Popen(['keyctl'] + args,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        return None  # keyutils not installed, no caching
+
+    output, _ = proc.communicate(input)
+
+    if proc.returncode:
+        return None
+
+    return output
+
+
+def keyring_read(name):
+    key_id = keyctl(['search', '@u', 'user', name])
+
+    if not key_id:
+        return None
+
+    value = keyctl(['pipe', key_id.decode().strip()])
+    return value.decode() if value else None
+
+
+def keyring_write(name, value, ttl):
+    key_id = keyctl(['padd', 'user', name, '@u'], input=value.encode())
+
+    if key_id:
+        keyctl(['timeout', key_id.decode().strip(), str(ttl)])
+
+
+def keyring_clear(name):
+    key_id = keyctl(['search', '@u', 'user', name])
+
+    if key_id:
+        keyctl(['unlink', key_id.decode().strip(), '@u'])
+
+
+def release_version(bin_dir):
+    try:
+        output = subprocess.check_output([osp.join(bin_dir, 'darknode'), '--version'],
+                                         stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    match = re.search(r'\d+(\.\d+)+', output.decode(errors='replace'))
+    return match.group(0) if match else None
+
+
+def fetch_url(url):
+    try:
+        with urlopen(url) as resp:
+            return resp.read()
+    except (URLError, OSError) as e:
+        raise ReleaseError('Failed to download {!r}: {}'.format(url, e))
+
+
+def write_json_file(filename, obj):
+    # Write then rename, so that readers and backups never see a partially
+    # written file
+    text = json.dumps(obj, indent=2, sort_keys=True) + '\n'
+    dirname = osp.dirname(filename)
+    os.makedirs(dirname, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(prefix='.' + osp.basename(filename) + '.', dir=dirname)
+
+    try:
+        with os.fdopen(fd, 'w') as fobj:
+            fobj.write(text)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+
+        os.replace(temp_file, filename)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+
+def read_json_file(filename):
+    with open(filename) as fobj:
+        text = fobj.read().strip()
+
+    try:
+        config = json.loads(text)
+    except ValueError:
+        raise ConfigError('Invalid json config {!r}, root must be an object'.format(filename))
+
+    return config
+
+
+def write_private_file(filename, text):
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+    with os.fdopen(fd, 'w') as fobj:
+        fobj.write(text)
+
+
+def file_sha256(filename):
+    with open(filename, 'rb') as fobj:
+        return fileobj_sha256(fobj)
+
+
+def fileobj_sha256(fobj):
+    digest = hashlib.sha256()
+
+    for block in iter(lambda: fobj.read(1024 * 1024), b''):
+        digest.update(block)
+
+    return digest.hexdigest()
+
+
+def search_replace_tf(dirname, pattern, repl, progress=None, nodes=True):
+    for filename in glob(osp.join(dirname, '*.tf')):
+        search_replace(filename, pattern, repl, progress)
+
+    if nodes:
+        for filename in glob(osp.join(dirname, 'darknodes/*/*.tf')):
+            search_replace(filename, pattern, repl, progress)
+
+
+def search_replace(filename, pattern, repl, progress=None):
+    notify(progress, 'info', 'Search and replace {!r}: {} -> {}'.format(filename, pattern, repl))
+
+    with open(filename) as fobj:
+        replaced = re.sub(pattern, repl, fobj.read())
+
+    with open(filename, 'w') as fobj:
+        fobj.write(replaced)
+
+
+@contextmanager
+def new_temp_dir():
+    memory_dir = '/dev/shm'
+    temp_dir = memory_dir if osp.isdir(memory_dir) else None
+    backup_dir = tempfile.mkdtemp(prefix='inkbot-', suffix='.bak', dir=temp_dir)
+
+    try:
+        yield backup_dir
+    finally:
+        shutil.rmtree(backup_dir, ignore_errors=True)
+
+
+def rsync(runner, src, dest, excludes=None):
+    def end_slash(dirname):
+        return dirname if dirname.endswith('/') else dirname + '/'
+
+    src = osp.expanduser(src)
+    dest = osp.expanduser(dest)
+
+    if not osp.exists(src):
+        return
+
+    cmd = ['rsync', '-avh']
+
+    if excludes:
+        for exclude in excludes:
+            cmd.append('--exclude={}'.format(exclude))
+
+    cmd += [end_slash(src), end_slash(dest)]
+    runner.run(list2cmdline(cmd))
+
+
+def num_jobs(jobs, default=default_jobs):
+    # Command line options come in as strings
+    return int(jobs) if jobs else default
+
+
+def wait_all(futures):
+    # Wait for every future before raising the first error, so that no
+    # worker is still running when the caller cleans up
+    errors = [f.exception() for f in futures]
+
+    for error in errors:
+        if error:
+            raise error
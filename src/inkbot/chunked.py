@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+'''
+Chunked authenticated encryption, an alternative to gpg that encrypts and
+decrypts on all cores
+
+The key is derived from the passphrase with scrypt, the stream is split
+into fixed size chunks and every chunk is sealed with AES-256-GCM. Chunks
+are numbered and the last one is flagged in the associated data, so
+reordered, tampered or truncated files fail to decrypt.
+
+Layout::
+
+    header: magic, scrypt log2(n), r, p, chunk size, salt, nonce prefix
+    chunk 0: chunk_size bytes of ciphertext + 16 bytes tag
+    ...
+    chunk N: less than chunk_size bytes of ciphertext + 16 bytes tag
+
+Every chunk except the last is full, so chunk i starts at
+header_size + i * (chunk_size + 16).
+
+Requires the cryptography package.
+'''
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import os
+import struct
+
+
+magic = b'INKBOTC1'
+header_format = '>8sBBBI16s4s'
+header_size = struct.calcsize(header_format)
+tag_size = 16
+default_chunk_size = 1024 * 1024
+default_jobs = os.cpu_count() or 1
+scrypt_log2_n = 15
+scrypt_r = 8
+scrypt_p = 1
+# Bounds on header fields, anything outside them is a damaged or hostile
+# header that would make scrypt fail or eat all memory
+min_chunk_size = 1024
+max_chunk_size = 64 * 1024 * 1024
+max_scrypt_mem = 1024 * 1024 * 1024
+
+
+class ChunkedError(Exception):
+    pass
+
+
+class Header(object):
+    def __init__(self, chunk_size=default_chunk_size, salt=None, nonce_prefix=None,
+                 log2_n=scrypt_log2_n, r=scrypt_r, p=scrypt_p):
+        self.chunk_size = chunk_size
+        self.salt = salt or os.urandom(16)
+        self.nonce_prefix = nonce_prefix or os.urandom(4)
+        self.log2_n = log2_n
+        self.r = r
+        self.p = p
+
+    @classmethod
+    def read(cls, fobj):
+        data = read_exactly(fobj, header_size)
+
+        if len(data) < header_size or not data.startswith(magic):
+            raise ChunkedError('Not a chunked encrypted file')
+
+        _, log2_n, r, p, chunk_size, salt, nonce_prefix = struct.unpack(header_format, data)
+        header = cls(chunk_size, salt, nonce_prefix, log2_n, r, p)
+        header.validate()
+        return header
+
+    def validate(self):
+        if not min_chunk_size <= self.chunk_size <= max_chunk_size:
+            raise ChunkedError('Invalid chunk size {} in header'.format(self.chunk_size))
+
+        if not (10 <= self.log2_n <= 20 and 1 <= self.r <= 16 and 1 <= self.p <= 16):
+            raise ChunkedError('Invalid scrypt parameters log2(n)={} r={} p={} in header'.format(
+                self.log2_n, self.r, self.p))
+
+        if 128 * self.r * (1 << self.log2_n) > max_scrypt_mem:
+            raise ChunkedError('scrypt parameters in header need too much memory')
+
+    def pack(self):
+        return struct.pack(header_format, magic, self.log2_n, self.r, self.p,
+                           self.chunk_size, self.salt, self.nonce_prefix)
+
+    def derive_key(self, passphrase):
+        n = 1 << self.log2_n
+
+        try:
+            return hashlib.scrypt(passphrase, salt=self.salt, n=n, r=self.r, p=self.p,
+                                  maxmem=256 * n * self.r, dklen=32)
+        except (ValueError, MemoryError) as e:
+            raise ChunkedError('Failed to derive key: {}'.format(e))
+
+    def nonce(self, index):
+        return self.nonce_prefix + struct.pack('>Q', index)
+
+    def aad(self, index, final):
+        return self.pack() + struct.pack('>QB', index, final)
+
+
+def is_chunked(filename):
+    with open(filename, 'rb') as fobj:
+        return fobj.read(len(magic)) == magic
+
+
+def aesgcm(key):
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise ChunkedError(("Chunked encryption requires the cryptography package,"
+                            " install it with 'pip install inkbot[chunked]'"))
+
+    return AESGCM(key)
+
+
+def encrypt(plain_fobj, cipher_fobj, passphrase=None, key=None, header=None, jobs=None):
+    '''
+    Encrypt plain_fobj to cipher_fobj with a key derived from passphrase, or
+    with key derived earlier from header, returns the key
+    '''
+    header = header or Header()
+    key = key or header.derive_key(passphrase)
+    cipher = aesgcm(key)
+    cipher_fobj.write(header.pack())
+
+    def seal(index, chunk, final):
+        return cipher.encrypt(header.nonce(index), chunk, header.aad(index, final))
+
+    with ThreadPoolExecutor(max_workers=jobs or default_jobs) as pool:
+        for sealed in ordered_map(pool, seal, plain_chunks(plain_fobj, header.chunk_size), jobs):
+            cipher_fobj.write(sealed)
+
+    return key
+
+
+def plain_chunks(fobj, chunk_size):
+    # The last chunk is always shorter than chunk_size, possibly empty
+    chunk = read_exactly(fobj, chunk_size)
+    index = 0
+
+    while len(chunk) == chunk_size:
+        next_chunk = read_exactly(fobj, chunk_size)
+        yield index, chunk, False
+        chunk = next_chunk
+        index += 1
+
+    yield index, chunk, True
+
+
+class Reader(io.RawIOBase):
+    '''
+    Readable stream of the plaintext of cipher_fobj, chunks are decrypted
+    ahead in a thread pool
+    '''
+    def __init__(self, cipher_fobj, passphrase=None, key=None, jobs=None):
+        self.fobj = cipher_fobj
+        self.header = Header.read(cipher_fobj)
+        self.key = key or self.header.derive_key(passphrase)
+        self.cipher = aesgcm(self.key)
+        self.jobs = jobs or default_jobs
+        self.pool = ThreadPoolExecutor(max_workers=self.jobs)
+        # Pipes can't seek, the header was just read so chunk 0 is next
+        self.start_chunks(0)
+
+    @property
+    def block_size(self):
+        return self.header.chunk_size + tag_size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self.buffer:
+            try:
+                self.buffer = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+
+        size = min(len(buf), len(self.buffer))
+        buf[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def seek_chunk(self, index):
+        '''
+        Continue reading from the start of chunk index, the file must be seekable
+        '''
+        self.fobj.seek(header_size + index * self.block_size)
+        self.start_chunks(index)
+
+    def start_chunks(self, index):
+        self.buffer = memoryview(b'')
+        self.chunks = ordered_map(self.pool, self.open_chunk,
+                                  cipher_chunks(self.fobj, self.block_size, index), self.jobs)
+
+    def read_chunk(self, index):
+        '''
+        Return plaintext of chunk index, the file must be seekable
+        '''
+        position = self.fobj.tell()
+
+        try:
+            self.fobj.seek(header_size + index * self.block_size)
+            data = read_exactly(self.fobj, self.block_size)
+            at_end = not self.fobj.read(1)
+        finally:
+            self.fobj.seek(position)
+
+        if not data:
+            raise ChunkedError('Chunk {} is beyond the end of the file'.format(index))
+
+        final = len(data) < self.block_size
+
+        if not final and at_end:
+            raise ChunkedError('File is truncated')
+
+        return self.open_chunk(index, data, final)
+
+    def open_chunk(self, index, data, final):
+        from cryptography.exceptions import InvalidTag
+
+        try:
+            return self.cipher.decrypt(self.header.nonce(index), data, self.header.aad(index, final))
+        except InvalidTag:
+            raise ChunkedError(('Chunk {} failed authentication, wrong passphrase or the file'
+                                ' is corrupted or truncated'.format(index)))
+
+    def close(self):
+        if not self.closed:
+            self.pool.shutdown(wait=True)
+
+        super(Reader, self).close()
+
+
+def cipher_chunks(fobj, block_size, index=0):
+    while True:
+        data = read_exactly(fobj, block_size)
+
+        if not data:
+            raise ChunkedError('File is truncated')
+
+        final = len(data) < block_size
+        yield index, data, final
+
+        if final:
+            return
+
+        index += 1
+
+
+def ordered_map(pool, func, items, jobs=None):
+    # Like pool.map() but lazy, only keeps a few chunks in flight so memory
+    # use doesn't grow with the file size
+    window = 2 * (jobs or default_jobs)
+    pending = deque()
+
+    for item in items:
+        pending.append(pool.submit(func, *item))
+
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def read_exactly(fobj, size):
+    # Pipes may return less than asked for before the end of the stream
+    buf = bytearray()
+
+    while len(buf) < size:
+        data = fobj.read(size - len(buf))
+
+        if not data:
+            break
+
+        buf += data
+
+    return bytes(buf)
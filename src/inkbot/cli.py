@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 from invoke import Collection, Program
 from . import tasks
+from .api import InkbotError
 import pkg_resources
+import sys
 
 
 class Inkbot(Program):
@@ -19,4 +21,8 @@ class Inkbot(Program):
 
 
 def main():
-    Inkbot().run()
+    try:
+        Inkbot().run()
+    except InkbotError as e:
+        print(e, file=sys.stderr)
+        raise SystemExit(1)
@@ -1,60 +1,70 @@
 # -*- coding: utf-8 -*-
-from contextlib import contextmanager
-from glob import glob
 from invoke import Failure, task
 from os import path as osp
 from subprocess import list2cmdline
-from textwrap import dedent
-import json
-import os
-import re
+from . import api
+from .api import Backup, CommandFailed, Fleet, Restore, TerraformError
 import requests
+import stat
 import sys
-import tempfile
+import time
 
 
-home_dir = osp.expanduser('~')
-real_darknode_dir = osp.join(home_dir, '.darknode')
-test_darknode_dir = real_darknode_dir + '-test'
-test = False  # set to True to darknode dir in ~/.darknode-test
-darknode_dir = test_darknode_dir if test else real_darknode_dir
-darknode_dir_var = '{{ darknode_dir }}'
-darknode_bin_dir = osp.join(darknode_dir, 'bin')
-inkbot_dir = osp.join(darknode_dir, 'inkbot')
-_darknode_in_path = None
-
-
-@task
-def install_darknode_cli(ctx, update=False):
+class ContextRunner(api.Runner):
     '''
-    Install darknode-cli if not already installed
+    Run commands through invoke so that they are echoed and get a terminal
     '''
-    if osp.exists(osp.join(real_darknode_dir, 'bin')):
-        if update:
-            ctx.run('curl https://releases.republicprotocol.com/darknode-cli/update.sh -sSf | sh')
-    else:
-        ctx.run('curl https://releases.republicprotocol.com/darknode-cli/install.sh -sSf | sh')
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    def run(self, cmdline, cwd=None, parallel=False, quiet=False, env=None):
+        kwargs = {}
+
+        if cwd:
+            # ctx.cd() isn't thread safe, cd in the command instead
+            cmdline = 'cd {} && {}'.format(list2cmdline([cwd]), cmdline)
+
+        if parallel:
+            # Concurrent runs can't share the terminal
+            kwargs.update(pty=False, in_stream=False)
 
-    if test:
-        rsync(ctx, real_darknode_dir, test_darknode_dir)
+        if quiet:
+            kwargs.update(hide=True)
 
+        if env:
+            kwargs.update(env=env)
 
-def darknode_bin(name='darknode'):
-    if darknode_in_path():
-        return name
+        try:
+            result = self.ctx.run(cmdline, **kwargs)
+        except Failure as e:
+            raise CommandFailed(cmdline, e.result.exited, e.result.stdout)
 
-    return osp.join(darknode_bin_dir, name)
+        return result.stdout
 
 
-def darknode_in_path():
-    global _darknode_in_path
+def get_fleet(ctx):
+    return Fleet(runner=ContextRunner(ctx))
 
-    if _darknode_in_path is None:
-        paths = os.environ['PATH'].split(os.pathsep)
-        bin_dir = osp.join(darknode_dir, 'bin')
-        _darknode_in_path = bin_dir in paths
 
-    return _darknode_in_path
+def print_event(event):
+    file = sys.stderr if event.kind in ('gpg', 'warning') else sys.stdout
+    print(event.message, file=file)
+
+
+@task
+def install_darknode_cli(ctx, update=False, version=None):
+    '''
+    Install darknode-cli if not already installed, from the release cache if possible
+    '''
+    get_fleet(ctx).install_darknode_cli(update, version, progress=print_event)
+
+
+@task
+def prefetch_darknode_cli(ctx, version=None):
+    '''
+    Download a darknode-cli release, the latest by default, into the release cache
+    '''
+    get_fleet(ctx).prefetch_darknode_cli(version, progress=print_event)
 
 
 @task
@@ -62,11 +72,9 @@ def set_aws_keys(ctx):
     '''
     Set AWS access key and secret key for adding new darknodes
     '''
-    dct = {
-        'accessKey': get_input('AWS access key: '),
-        'secretKey': get_input('AWS secret key: ')
-    }
-    write_json_file(osp.join(inkbot_dir, 'aws.json'), dct)
+    access_key = get_input('AWS access key: ')
+    secret_key = get_input('AWS secret key: ')
+    print('Writing to {!r}'.format(get_fleet(ctx).set_aws_keys(access_key, secret_key)))
 
 
 @task
@@ -74,7 +82,7 @@ def aws_access_key(ctx):
     '''
     Print AWS access key set by 'inkbot set-aws-keys'
     '''
-    print(read_aws_keys()[0])
+    print(get_fleet(ctx).aws_keys()[0])
 
 
 @task
@@ -82,51 +90,7 @@ def aws_secret_key(ctx):
     '''
     Print AWS secret key set by 'inkbot set-aws-keys'
     '''
-    print(read_aws_keys()[1])
-
-
-def read_aws_keys():
-    try:
-        config = read_json_file(osp.join(inkbot_dir, 'aws.json'))
-    except FileNotFoundError:
-        error_exit("AWS keys not found, please run 'inkbot set-aws-keys' to set them")
-
-    access_key = config.get('accessKey')
-
-    if not access_key:
-        error_exit("AWS access key not found, please run 'inkbot set-aws-keys' to set it")
-
-    secret_key = config.get('secretKey')
-
-    if not secret_key:
-        error_exit("AWS secret key not found, please run 'inkbot set-aws-keys' to set it")
-
-    return access_key, secret_key
-
-
-def write_json_file(filename, obj):
-    print('Writing to {!r}'.format(filename))
-    text = json.dumps(obj, indent=2, sort_keys=True) + '\n'
-
-    try:
-        os.makedirs(osp.dirname(filename))
-    except FileExistsError:
-        pass
-
-    with open(filename, 'w') as fobj:
-        fobj.write(text)
-
-
-def read_json_file(filename):
-    with open(filename) as fobj:
-        text = fobj.read().strip()
-
-    try:
-        config = json.loads(text)
-    except ValueError:
-        error_exit('Invalid json config {!r}, root must be an object'.format(filename))
-
-    return config
+    print(get_fleet(ctx).aws_keys()[1])
 
 
 def error_exit(message):
@@ -139,10 +103,8 @@ def set_do_token(ctx):
     '''
     Set Digital Ocean token for adding new darknodes
     '''
-    dct = {
-        'token': get_input('Digital Ocean token: ')
-    }
-    write_json_file(osp.join(inkbot_dir, 'do.json'), dct)
+    token = get_input('Digital Ocean token: ')
+    print('Writing to {!r}'.format(get_fleet(ctx).set_do_token(token)))
 
 
 @task
@@ -150,28 +112,7 @@ def do_token(ctx):
     '''
     Print Digital Ocean token set by 'inkbot set-do-token'
     '''
-    print(get_do_token())
-
-
-def get_do_token():
-    def error():
-        error_exit("DO token not found, please run 'inkbot set-do-token' to set it")
-
-    try:
-        config = read_json_file(osp.join(inkbot_dir, 'do.json'))
-    except FileNotFoundError:
-        error()
-
-    token = config.get('token')
-
-    if not token:
-        error()
-
-    return token
-
-
-def make_inkbot_dir(ctx):
-    ctx.run(list2cmdline(['mkdir', '-p', inkbot_dir]), echo=False)
+    print(get_fleet(ctx).do_token())
 
 
 def get_input(prompt):
@@ -191,33 +132,12 @@ def add_aws_node(ctx, name, print_command=False, network=None, region=None, inst
     '''
     Add a AWS darknode using credentials set by 'inkbot set-aws-keys'
     '''
-    cmd = [
-        darknode_bin(), 'up',
-        '--name', name,
-    ]
-
-    if network:
-        cmd += ['--network', network]
-
-    cmd += [
-        '--aws',
-        '--aws-access-key', '$(inkbot aws-access-key)',
-        '--aws-secret-key', '$(inkbot aws-secret-key)',
-    ]
-
-    if region:
-        cmd += ['--aws-region', region]
-
-    if instance:
-        cmd += ['--aws-instance', instance]
-
-    cmdline = list2cmdline(cmd)
+    fleet = get_fleet(ctx)
 
     if print_command:
-        print(cmdline)
+        print(fleet.aws_node_command(name, network, region, instance))
     else:
-        install_darknode_cli(ctx)
-        ctx.run(cmdline)
+        fleet.add_aws_node(name, network, region, instance, progress=print_event)
 
 
 @task
@@ -225,32 +145,12 @@ def add_do_node(ctx, name, print_command=False, network=None, region=None, dropl
     '''
     Add a Digital Ocean darknode using credentials set by 'inkbot set-do-token'
     '''
-    cmd = [
-        darknode_bin(), 'up',
-        '--name', name,
-    ]
-
-    if network:
-        cmd += ['--network', network]
-
-    cmd += [
-        '--do',
-        '--do-token', '$(inkbot do-token)',
-    ]
-
-    if region:
-        cmd += ['--do-region', region]
-
-    if droplet:
-        cmd += ['--do-droplet', droplet]
-
-    cmdline = list2cmdline(cmd)
+    fleet = get_fleet(ctx)
 
     if print_command:
-        print(cmdline)
+        print(fleet.do_node_command(name, network, region, droplet))
     else:
-        install_darknode_cli(ctx)
-        ctx.run(cmdline)
+        fleet.add_do_node(name, network, region, droplet, progress=print_event)
 
 
 @task
@@ -269,7 +169,7 @@ def do_regions(ctx, sizes=False):
         return ''.join(buf)
 
     headers = {
-        'Authorization': 'Bearer {}'.format(get_do_token())
+        'Authorization': 'Bearer {}'.format(get_fleet(ctx).do_token())
     }
     resp = requests.get('https://api.digitalocean.com/v2/regions', headers=headers)
     regions = resp.json().get('regions', [])
@@ -280,189 +180,167 @@ def do_regions(ctx, sizes=False):
 
 
 @task
-def backup(ctx, backup_file):
+def backup(ctx, backup_file, passphrase_fd=None, chunked=False, jobs=None):
     '''
     Backup darknodes and credentials to <backup-file>
     '''
-    os.stat(osp.dirname(osp.abspath(backup_file)))  # validate dir
-
-    with new_temp_dir(ctx) as backup_dir:
-        excludes = [
-            '.terraform',
-            '/bin/',
-            '/darknode-setup',
-            '/gen-config',
-        ]
-        rsync(ctx, darknode_dir, osp.join(backup_dir), excludes)
-        search_replace_tf(backup_dir, re.escape(darknode_dir), darknode_dir_var)
-        archive_encrypt(ctx, backup_dir, backup_file)
-
-
-def search_replace_tf(dirname, pattern, repl):
-    for filename in glob(osp.join(dirname, '*.tf')):
-        search_replace(filename, pattern, repl)
-
-    for filename in glob(osp.join(dirname, 'darknodes/*/*.tf')):
-        search_replace(filename, pattern, repl)
-
-
-def search_replace(filename, pattern, repl):
-    print('Search and replace {!r}: {} -> {}'.format(filename, pattern, repl))
-
-    with open(filename) as fobj:
-        replaced = re.sub(pattern, repl, fobj.read())
-
-    with open(filename, 'w') as fobj:
-        fobj.write(replaced)
+    Backup(get_fleet(ctx), passphrase_fd, chunked, jobs).run(backup_file, progress=print_event)
 
 
 @task
-def restore(ctx, backup_file):
+def restore(ctx, backup_file, passphrase_fd=None, jobs=None):
     '''
     Restore darknodes and credentials from <backup-file>
     '''
-    install_darknode_cli(ctx)
-
-    with new_temp_dir(ctx) as backup_dir:
-        decrypt_extract(ctx, backup_file, backup_dir)
-        search_replace_tf(backup_dir, re.escape(darknode_dir_var), darknode_dir)
-        rsync(ctx, backup_dir, darknode_dir)
-        extra_nodes = compare_darknodes(backup_dir, darknode_dir)
-
     try:
-        terraform_init(ctx)
-    except Failure:
-        print("'terraform init' failed, you can try again with 'inkbot terraform-init'")
-        raise
+        result = Restore(get_fleet(ctx), passphrase_fd).run(backup_file, jobs, progress=print_event)
+    except TerraformError as e:
+        error_exit("{}\nYou can try again with 'inkbot terraform-init'".format(e))
 
-    if extra_nodes:
+    if result.extra_nodes:
         print(("Extra darknodes {!r} are left untouched,"
-               " to remove them you have to do it manually".format(extra_nodes)))
-
-
-def compare_darknodes(backup_dir, darknode_dir):
-    def nodes(dirname):
-        dirs = glob(osp.join(dirname, 'darknodes/*'))
-        return [osp.basename(d) for d in dirs]
-
-    backup_nodes = nodes(backup_dir)
-    current_nodes = nodes(darknode_dir)
-    extra_nodes = set(current_nodes).difference(backup_nodes)
-    return sorted(list(extra_nodes))
+               " to remove them you have to do it manually".format(result.extra_nodes)))
 
 
 @task
-def terraform_init(ctx, force=False):
+def diff_backup(ctx, backup_file, passphrase_fd=None):
     '''
-    Run 'terraform init' in darknode directories
+    Compare files inside <backup-file> against the darknode dir without extracting it
     '''
-    def init(dirname):
-        if glob(osp.join(dirname, '*.tf')):
-            if force or not osp.exists(osp.join(dirname, '.terraform')):
-                with ctx.cd(dirname):
-                    ctx.run(list2cmdline([darknode_bin('terraform'), 'init']))
+    diffs = Restore(get_fleet(ctx), passphrase_fd).diff(backup_file, progress=print_event)
+
+    if not diffs:
+        print('No differences')
+        return
 
-    init(darknode_dir)
+    for node in sorted(diffs, key=lambda n: n or ''):
+        diff = diffs[node]
+        print("darknode {!r}:".format(node) if node else 'top level:')
 
-    darknodes_dir = osp.join(darknode_dir, 'darknodes')
+        for label, paths in [('only in backup', diff.added),
+                             ('only in darknode dir', diff.removed),
+                             ('modified', diff.modified)]:
+            for path in paths:
+                print('  {}: {}'.format(label, path))
 
-    if osp.exists(darknodes_dir):
-        for name in os.listdir(darknodes_dir):
-            init(osp.join(darknodes_dir, name))
 
+@task
+def find_backup(ctx, query):
+    '''
+    Find backups containing darknode or file <query> using the backup catalog
+    '''
+    found = get_fleet(ctx).catalog.find(query)
 
-@contextmanager
-def new_temp_dir(ctx):
-    memory_dir = '/dev/shm'
-    temp_dir = memory_dir if osp.isdir(memory_dir) else None
-    backup_dir = tempfile.mkdtemp(prefix='inkbot-', suffix='.bak', dir=temp_dir)
+    if not found:
+        error_exit('{!r} not found in any cataloged backup'.format(query))
 
-    try:
-        yield backup_dir
-    finally:
-        ctx.run(list2cmdline(['rm', '-rf', backup_dir]))
+    for f in found:
+        print('{}  {}  {}  {} bytes  {}'.format(
+            f.created, f.backup_file or '-', f.path, f.size, f.sha256[:12]))
 
 
-def rsync(ctx, src, dest, excludes=None):
-    def end_slash(dirname):
-        return dirname if dirname.endswith('/') else dirname + '/'
+@task
+def catalog_backup(ctx, backup_file, passphrase_fd=None):
+    '''
+    Add an existing <backup-file> to the backup catalog
+    '''
+    fleet = get_fleet(ctx)
+    manifest = Restore(fleet, passphrase_fd).manifest(backup_file, progress=print_event)
+    created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(osp.getmtime(backup_file)))
+    fleet.catalog.add(osp.abspath(backup_file), manifest, created)
+    print('Recorded {} files in catalog {!r}'.format(len(manifest), fleet.catalog.filename))
 
-    src = osp.expanduser(src)
-    dest = osp.expanduser(dest)
 
-    if not osp.exists(src):
-        print('{!r} does not exist, not rsyncing it'.format(src))
-        return
+@task
+def terraform_init(ctx, force=False, jobs=None):
+    '''
+    Run 'terraform init' in darknode directories
+    '''
+    get_fleet(ctx).terraform_init(force, jobs, progress=print_event)
 
-    cmd = ['rsync', '-avh']
 
-    if excludes:
-        for exclude in excludes:
-            cmd.append('--exclude={}'.format(exclude))
+@task
+def drift(ctx, jobs=None, force=False):
+    '''
+    Run 'terraform plan' in darknode directories to find infrastructure drift
+    '''
+    for result in get_fleet(ctx).drift(force, jobs, progress=print_event):
+        print('{}: {}{}'.format(
+            "darknode {!r}".format(result.node) if result.node else 'top level',
+            result.summary,
+            ' (cached)' if result.cached else ''))
 
-    cmd += [end_slash(src), end_slash(dest)]
-    ctx.run(list2cmdline(cmd))
+        for change in result.changes:
+            print('  {}'.format(change))
 
 
 @task
-def archive_encrypt(ctx, src_dir, backup_file):
+def archive_encrypt(ctx, src_dir, backup_file, passphrase_fd=None, chunked=False, jobs=None):
     '''
     Archive <src-dir> into tar file and encrypt it to <backup-file>
     '''
-    with new_temp_dir(ctx) as temp_dir:
-        archive_file = osp.abspath(osp.join(temp_dir, osp.basename(backup_file) + '.tgz'))
-
-        with ctx.cd(src_dir):
-            ctx.run(list2cmdline(['tar', '-czf', archive_file, '*']))
+    runner = ContextRunner(ctx)
 
-        encrypt(ctx, archive_file, backup_file)
+    with api.new_temp_dir() as temp_dir:
+        archive_file = osp.abspath(osp.join(temp_dir, osp.basename(backup_file) + '.tgz'))
+        runner.run(list2cmdline(['tar', '-czf', archive_file, '--'] + api.archive_names(src_dir)),
+                   cwd=src_dir)
+        api.encrypt(runner, archive_file, backup_file, passphrase_fd, chunked, jobs)
 
 
 @task
-def decrypt_extract(ctx, backup_file, dest_dir):
+def decrypt_extract(ctx, backup_file, dest_dir, passphrase_fd=None):
     '''
-    Decrypt <backup-file> to a tar file and extract it to <dest-dir>
+    Decrypt <backup-file> and extract it to <dest-dir>
     '''
-    with decrypted(ctx, backup_file) as archive_file:
-        if not osp.exists(dest_dir):
-            ctx.run(list2cmdline(['mkdir', '-p', dest_dir]))
-
-        ctx.run(list2cmdline(['tar', '-C', dest_dir, '-xzf', archive_file]))
+    Restore(get_fleet(ctx), passphrase_fd).extract(backup_file, dest_dir, progress=print_event)
 
 
 @task
-def list_backup(ctx, backup_file):
+def list_backup(ctx, backup_file, passphrase_fd=None):
     '''
     List files inside <backup-file>
     '''
-    with decrypted(ctx, backup_file) as archive_file:
-        ctx.run(list2cmdline(['tar', '-tvf', archive_file]))
+    for member in Restore(get_fleet(ctx), passphrase_fd).list(backup_file, progress=print_event):
+        print(format_member(member))
 
 
-@contextmanager
-def decrypted(ctx, backup_file):
-    with new_temp_dir(ctx) as temp_dir:
-        archive_file = osp.abspath(osp.join(temp_dir, osp.basename(backup_file) + '.tgz'))
-        decrypt(ctx, backup_file, archive_file)
-        yield archive_file
+def format_member(member):
+    if member.isdir():
+        file_type = stat.S_IFDIR
+    elif member.issym():
+        file_type = stat.S_IFLNK
+    else:
+        file_type = stat.S_IFREG
+
+    return '{} {}/{} {:>5} {} {}'.format(
+        stat.filemode(file_type | member.mode),
+        member.uname or member.uid, member.gname or member.gid,
+        member.size,
+        time.strftime('%Y-%m-%d %H:%M', time.localtime(member.mtime)),
+        member.name + '/' if member.isdir() else member.name)
 
 
 @task
-def encrypt(ctx, plain_file, cipher_file):
+def encrypt(ctx, plain_file, cipher_file, passphrase_fd=None, chunked=False, jobs=None):
     '''
     Encrypt <plain-file> to <cipher-file>
     '''
-    ctx.run(list2cmdline([
-        'gpg', '--cipher-algo', 'AES256',
-        '-c',
-        '-o', cipher_file,
-        plain_file
-    ]))
+    api.encrypt(ContextRunner(ctx), plain_file, cipher_file, passphrase_fd, chunked, jobs)
+
+
+@task
+def decrypt(ctx, cipher_file, plain_file, passphrase_fd=None, no_cache=False):
+    '''
+    Decrypt <cipher-file> to <plain-file>, reusing a cached session key if any
+    '''
+    api.decrypt(ContextRunner(ctx), cipher_file, plain_file, passphrase_fd, no_cache,
+                progress=print_event)
 
 
 @task
-def decrypt(ctx, cipher_file, plain_file):
+def forget_session_key(ctx, backup_file):
     '''
-    Decrypt <cipher-file> to <plain-file>
+    Remove cached session key of <backup-file> from the keyring
     '''
-    ctx.run(list2cmdline(['gpg', '-o', plain_file, cipher_file]))
+    api.forget_session_key(backup_file)
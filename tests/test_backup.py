@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+from inkbot import api
+from inkbot.api import Backup, BackupError, Fleet, Restore
+from os import path as osp
+from test_release import ReleaseServer
+from unittest import mock
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+try:
+    import cryptography  # noqa
+except ImportError:
+    cryptography = None
+
+
+passphrase = 'correct horse battery staple'
+
+
+def passphrase_fd(times=1):
+    # Like a terminal answering the passphrase prompt times times
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, (passphrase + '\n').encode() * times)
+    os.close(write_fd)
+    return read_fd
+
+
+def write_file(filename, content):
+    os.makedirs(osp.dirname(filename), exist_ok=True)
+
+    with open(filename, 'w') as fobj:
+        fobj.write(content)
+
+
+def read_file(filename):
+    with open(filename) as fobj:
+        return fobj.read()
+
+
+@unittest.skipIf(shutil.which('rsync') is None, 'rsync is not installed')
+@unittest.skipIf(cryptography is None, 'cryptography is not installed')
+class BackupTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='inkbot-test-')
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.server = ReleaseServer()
+        self.addCleanup(self.server.close)
+        self.server.publish('1.0.0', files={
+            'bin/terraform': '#!/bin/sh\nmkdir -p .terraform\n',
+        })
+        patcher = mock.patch.dict(os.environ, {'INKBOT_RELEASE_URL': self.server.url})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.fleet = Fleet(osp.join(self.temp_dir, 'src'))
+        self.fleet.install_darknode_cli()
+        self.fleet.set_do_token('token')
+        node_dir = osp.join(self.fleet.darknodes_dir, 'node1')
+        write_file(osp.join(node_dir, 'main.tf'), 'key = "{}/darknodes/node1/ssh_keypair"\n'.format(
+            self.fleet.darknode_dir))
+        write_file(osp.join(node_dir, 'config.json'), '{}\n')
+        self.backup_file = osp.join(self.temp_dir, 'backup.tgz.enc')
+        fd = passphrase_fd()
+        self.addCleanup(os.close, fd)
+        Backup(self.fleet, fd, use_chunked=True).run(self.backup_file)
+
+    def restore(self, fleet, **kwargs):
+        fd = passphrase_fd()
+        self.addCleanup(os.close, fd)
+        return Restore(fleet, fd, no_cache=True).run(self.backup_file, **kwargs)
+
+    def test_restore_into_empty_dir(self):
+        fleet = Fleet(osp.join(self.temp_dir, 'dest'))
+        result = self.restore(fleet)
+
+        self.assertEqual(result.nodes, ['node1'])
+        self.assertEqual(result.extra_nodes, [])
+        node_dir = osp.join(fleet.darknodes_dir, 'node1')
+        self.assertEqual(read_file(osp.join(node_dir, 'main.tf')),
+                         'key = "{}/darknodes/node1/ssh_keypair"\n'.format(fleet.darknode_dir))
+        self.assertTrue(osp.isdir(osp.join(node_dir, '.terraform')))
+        self.assertEqual(fleet.do_token(), 'token')
+        self.assertEqual(fleet.pinned_release()['version'], '1.0.0')
+
+
+class BackupPathTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='inkbot-test-')
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.fleet = Fleet(osp.join(self.temp_dir, 'darknode'))
+        self.missing_file = osp.join(self.temp_dir, 'missing.gpg')
+
+    def test_missing_backup_file(self):
+        restore = Restore(self.fleet)
+
+        for func in [restore.list, restore.manifest, restore.diff, restore.run]:
+            with self.assertRaisesRegex(BackupError, "Can't read backup file"):
+                func(self.missing_file)
+
+        with self.assertRaisesRegex(BackupError, "Can't read backup file"):
+            api.decrypt(api.Runner(), self.missing_file, osp.join(self.temp_dir, 'plain'))
+
+        # Failed before installing darknode-cli
+        self.assertFalse(osp.exists(self.fleet.bin_dir))
+
+    def test_missing_backup_dir(self):
+        with self.assertRaisesRegex(BackupError, 'does not exist'):
+            Backup(self.fleet).run(osp.join(self.temp_dir, 'missing', 'backup.gpg'))
+
+
+@unittest.skipIf(shutil.which('gpg') is None, 'gpg is not installed')
+class GpgStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='inkbot-test-')
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        patcher = mock.patch.dict(os.environ, {'GNUPGHOME': osp.join(self.temp_dir, 'gnupg')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.mkdir(os.environ['GNUPGHOME'], 0o700)
+
+        # Much more than a pipe buffer follows the first darknode
+        archive_file = osp.join(self.temp_dir, 'backup.tgz')
+
+        with tarfile.open(archive_file, 'w:gz') as tar:
+            for name, data in [('darknodes/a/config.json', b'{}'),
+                               ('darknodes/b/big', os.urandom(1024 * 1024))]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+        self.backup_file = osp.join(self.temp_dir, 'backup.tgz.gpg')
+        fd = passphrase_fd()
+        self.addCleanup(os.close, fd)
+        api.encrypt(api.Runner(), archive_file, self.backup_file, fd)
+
+    def test_error_while_extracting(self):
+        # The real error surfaces, not gpg dying of SIGPIPE when the pipe
+        # is closed early
+        def node_extracted(name):
+            raise RuntimeError('rsync failed')
+
+        fd = passphrase_fd()
+        self.addCleanup(os.close, fd)
+        restore = Restore(Fleet(osp.join(self.temp_dir, 'darknode')), fd, no_cache=True)
+
+        with self.assertRaisesRegex(RuntimeError, 'rsync failed'):
+            restore.extract(self.backup_file, osp.join(self.temp_dir, 'extract'), node_extracted)
+
+
+if __name__ == '__main__':
+    unittest.main()
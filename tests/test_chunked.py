@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from inkbot import api, chunked
+from inkbot.chunked import ChunkedError, Header, Reader
+from os import path as osp
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+try:
+    import cryptography  # noqa
+except ImportError:
+    cryptography = None
+
+
+passphrase = b'correct horse battery staple'
+chunk_size = 1024
+
+
+def new_header():
+    # Cheap scrypt so the tests run fast
+    return Header(chunk_size=chunk_size, log2_n=10, r=8, p=1)
+
+
+def encrypt(plain, header=None):
+    cipher_fobj = io.BytesIO()
+    chunked.encrypt(io.BytesIO(plain), cipher_fobj, passphrase, header=header or new_header(), jobs=2)
+    return cipher_fobj.getvalue()
+
+
+def decrypt(cipher, passphrase=passphrase):
+    with Reader(io.BytesIO(cipher), passphrase, jobs=2) as reader:
+        return reader.read()
+
+
+def chunk_offset(index):
+    return chunked.header_size + index * (chunk_size + chunked.tag_size)
+
+
+@unittest.skipIf(cryptography is None, 'cryptography is not installed')
+class ChunkedTest(unittest.TestCase):
+    def test_round_trip(self):
+        for size in [0, 1, chunk_size - 1, chunk_size, chunk_size + 1, 5 * chunk_size, 5 * chunk_size + 7]:
+            plain = os.urandom(size)
+            self.assertEqual(decrypt(encrypt(plain)), plain, size)
+
+    def test_stream(self):
+        plain = os.urandom(3 * chunk_size + 10)
+        read_fd, write_fd = os.pipe()
+
+        with os.fdopen(write_fd, 'wb') as fobj:
+            fobj.write(encrypt(plain))
+
+        with os.fdopen(read_fd, 'rb') as fobj, Reader(fobj, passphrase) as reader:
+            self.assertEqual(reader.read(), plain)
+
+    def test_wrong_passphrase(self):
+        with self.assertRaises(ChunkedError):
+            decrypt(encrypt(b'secret'), b'wrong')
+
+    def test_tampered(self):
+        cipher = bytearray(encrypt(os.urandom(3 * chunk_size)))
+        cipher[chunk_offset(1) + 5] ^= 1
+
+        with self.assertRaises(ChunkedError):
+            decrypt(bytes(cipher))
+
+    def test_tampered_header(self):
+        cipher = bytearray(encrypt(os.urandom(chunk_size)))
+        cipher[chunked.header_size - 1] ^= 1  # nonce prefix
+
+        with self.assertRaises(ChunkedError):
+            decrypt(bytes(cipher))
+
+    def test_truncated_at_chunk_boundary(self):
+        cipher = encrypt(os.urandom(3 * chunk_size + 10))
+
+        for index in range(1, 4):
+            with self.assertRaises(ChunkedError):
+                decrypt(cipher[:chunk_offset(index)])
+
+    def test_truncated_mid_chunk(self):
+        cipher = encrypt(os.urandom(3 * chunk_size + 10))
+
+        with self.assertRaises(ChunkedError):
+            decrypt(cipher[:chunk_offset(1) + 100])
+
+    def test_reordered(self):
+        cipher = encrypt(os.urandom(3 * chunk_size + 10))
+        chunks = [cipher[chunk_offset(i):chunk_offset(i + 1)] for i in range(3)]
+        reordered = cipher[:chunked.header_size] + chunks[1] + chunks[0] + chunks[2] + cipher[chunk_offset(3):]
+
+        with self.assertRaises(ChunkedError):
+            decrypt(reordered)
+
+    def test_seek_chunk(self):
+        plain = os.urandom(4 * chunk_size + 10)
+
+        with Reader(io.BytesIO(encrypt(plain)), passphrase) as reader:
+            self.assertEqual(chunked.read_exactly(reader, chunk_size + 3), plain[:chunk_size + 3])
+            reader.seek_chunk(2)
+            self.assertEqual(reader.read(), plain[2 * chunk_size:])
+            reader.seek_chunk(0)
+            self.assertEqual(reader.read(), plain)
+
+    def test_read_chunk(self):
+        plain = os.urandom(2 * chunk_size + 10)
+
+        with Reader(io.BytesIO(encrypt(plain)), passphrase) as reader:
+            self.assertEqual(reader.read_chunk(2), plain[2 * chunk_size:])
+            self.assertEqual(reader.read_chunk(0), plain[:chunk_size])
+            self.assertEqual(reader.read(), plain)
+
+            with self.assertRaises(ChunkedError):
+                reader.read_chunk(3)
+
+    def test_not_chunked(self):
+        with self.assertRaises(ChunkedError):
+            decrypt(b'-----BEGIN PGP MESSAGE-----' + b'\0' * 100)
+
+    def test_bad_header(self):
+        header = new_header()
+        good = header.pack()
+
+        for field, value in [('log2_n', 40), ('log2_n', 0), ('r', 0), ('r', 255), ('p', 0),
+                             ('chunk_size', 0), ('chunk_size', 2 ** 32 - 1)]:
+            values = list(struct.unpack(chunked.header_format, good))
+            index = ['magic', 'log2_n', 'r', 'p', 'chunk_size'].index(field)
+            values[index] = value
+            cipher = struct.pack(chunked.header_format, *values) + b'\0' * 100
+
+            with self.assertRaises(ChunkedError, msg=field):
+                decrypt(cipher)
+
+
+@unittest.skipIf(cryptography is None, 'cryptography is not installed')
+class ChunkedApiTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='inkbot-test-')
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.plain = os.urandom(3 * chunked.default_chunk_size + 10)
+        self.plain_file = osp.join(self.temp_dir, 'plain')
+
+        with open(self.plain_file, 'wb') as fobj:
+            fobj.write(self.plain)
+
+    def passphrase_fd(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, passphrase + b'\n')
+        os.close(write_fd)
+        self.addCleanup(os.close, read_fd)
+        return read_fd
+
+    def decrypt(self, cipher_file, jobs=None):
+        with api.chunked_stream(cipher_file, self.passphrase_fd(), no_cache=True, jobs=jobs) as stream:
+            return stream.read()
+
+    def test_jobs_from_command_line(self):
+        # invoke passes --jobs as a string, as in 'inkbot encrypt --chunked --jobs 3'
+        cipher_file = osp.join(self.temp_dir, 'cipher')
+        api.encrypt(api.Runner(), self.plain_file, cipher_file, self.passphrase_fd(), use_chunked=True, jobs='3')
+        self.assertEqual(self.decrypt(cipher_file, jobs='2'), self.plain)
+
+    def test_default_jobs(self):
+        cipher_file = osp.join(self.temp_dir, 'cipher')
+        api.encrypt(api.Runner(), self.plain_file, cipher_file, self.passphrase_fd(), use_chunked=True)
+        self.assertEqual(self.decrypt(cipher_file), self.plain)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from inkbot.api import Fleet
+from os import path as osp
+import os
+import shutil
+import tempfile
+import unittest
+
+
+# Stub terraform, 'plan' prints plan.out and exits with the code in
+# plan.exit, every plan is logged to plan.log
+terraform_stub = '''#!/bin/sh
+case "$1" in
+init)
+    mkdir -p .terraform
+    ;;
+plan)
+    echo plan >> plan.log
+    cat plan.out
+    exit $(cat plan.exit)
+    ;;
+esac
+'''
+
+drifted_plan = '''
+  # aws_instance.darknode will be updated in-place
+  ~ resource "aws_instance" "darknode" {
+    }
+
+  # aws_security_group.darknode must be replaced
+-/+ resource "aws_security_group" "darknode" {
+    }
+
+Plan: 1 to add, 1 to change, 1 to destroy.
+'''
+
+
+def write_file(filename, content):
+    os.makedirs(osp.dirname(filename), exist_ok=True)
+
+    with open(filename, 'w') as fobj:
+        fobj.write(content)
+
+
+class DriftTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='inkbot-test-')
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.fleet = Fleet(osp.join(self.temp_dir, 'darknode'))
+        write_file(self.fleet.bin('terraform'), terraform_stub)
+        os.chmod(self.fleet.bin('terraform'), 0o755)
+
+        for node, exit_code, output in [('clean', 0, 'No changes.\n'),
+                                        ('drifted', 2, drifted_plan),
+                                        ('broken', 1, 'Error: no credentials\n')]:
+            self.write_node_file(node, 'main.tf', 'resource "aws_instance" "darknode" {}\n')
+            self.write_node_file(node, 'plan.exit', str(exit_code))
+            self.write_node_file(node, 'plan.out', output)
+
+    def write_node_file(self, node, name, content):
+        write_file(osp.join(self.fleet.darknodes_dir, node, name), content)
+
+    def drift(self, force=False):
+        return {r.node: r for r in self.fleet.drift(force=force, jobs='2')}
+
+    def plan_runs(self, node):
+        try:
+            with open(osp.join(self.fleet.darknodes_dir, node, 'plan.log')) as fobj:
+                return len(fobj.readlines())
+        except FileNotFoundError:
+            return 0
+
+    def test_results(self):
+        results = self.drift()
+        self.assertEqual(sorted(results), ['broken', 'clean', 'drifted'])
+
+        clean = results['clean']
+        self.assertIs(clean.drifted, False)
+        self.assertEqual(clean.summary, 'No changes')
+        self.assertEqual(clean.changes, [])
+        self.assertFalse(clean.cached)
+
+        drifted = results['drifted']
+        self.assertIs(drifted.drifted, True)
+        self.assertEqual(drifted.summary, 'Plan: 1 to add, 1 to change, 1 to destroy.')
+        self.assertEqual(drifted.changes, ['aws_instance.darknode will be updated in-place',
+                                           'aws_security_group.darknode must be replaced'])
+
+        broken = results['broken']
+        self.assertIsNone(broken.drifted)
+        self.assertIn('exit code 1', broken.summary)
+
+        for node in results:
+            self.assertTrue(osp.isdir(osp.join(self.fleet.darknodes_dir, node, '.terraform')))
+
+    def test_cached(self):
+        self.drift()
+        results = self.drift()
+
+        self.assertTrue(results['clean'].cached)
+        self.assertTrue(results['drifted'].cached)
+        self.assertEqual(results['drifted'].changes, self.drift()['drifted'].changes)
+        self.assertEqual(self.plan_runs('clean'), 1)
+        self.assertEqual(self.plan_runs('drifted'), 1)
+
+        # Failed plans are not cached
+        self.assertFalse(results['broken'].cached)
+        self.assertEqual(self.plan_runs('broken'), 3)
+
+    def test_changed_config_or_state(self):
+        self.drift()
+        self.write_node_file('clean', 'main.tf', 'resource "aws_instance" "darknode" { ami = "x" }\n')
+        self.write_node_file('drifted', 'terraform.tfstate', '{"serial": 2}\n')
+        results = self.drift()
+
+        self.assertFalse(results['clean'].cached)
+        self.assertFalse(results['drifted'].cached)
+        self.assertEqual(self.plan_runs('clean'), 2)
+        self.assertEqual(self.plan_runs('drifted'), 2)
+
+    def test_force(self):
+        self.drift()
+        results = self.drift(force=True)
+
+        self.assertFalse(any(r.cached for r in results.values()))
+        self.assertEqual(self.plan_runs('clean'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
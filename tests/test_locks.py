@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from inkbot import api
+from inkbot.api import Backup, Fleet, InkbotError
+from os import path as osp
+from unittest import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+
+class RecordingRunner(api.Runner):
+    '''
+    Records command lines instead of running them
+    '''
+    def __init__(self):
+        self.cmdlines = []
+
+    def run(self, cmdline, cwd=None, parallel=False, quiet=False, env=None):
+        self.cmdlines.append(cmdline)
+        return ''
+
+    def synced(self, dirname):
+        return any(cmdline.endswith(' ' + dirname + '/') for cmdline in self.cmdlines)
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+
+    while not predicate():
+        if time.time() > deadline:
+            return False
+
+        time.sleep(0.01)
+
+    return True
+
+
+class WriteJsonFileTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='inkbot-test-')
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.filename = osp.join(self.temp_dir, 'config.json')
+
+    def test_write(self):
+        api.write_json_file(self.filename, {'a': 1})
+        self.assertEqual(api.read_json_file(self.filename), {'a': 1})
+        self.assertEqual(os.listdir(self.temp_dir), ['config.json'])
+
+    def test_failed_write(self):
+        api.write_json_file(self.filename, {'a': 1})
+
+        with mock.patch.object(os, 'fsync', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                api.write_json_file(self.filename, {'a': 2})
+
+        self.assertEqual(api.read_json_file(self.filename), {'a': 1})
+        self.assertEqual(os.listdir(self.temp_dir), ['config.json'])
+
+    def test_failed_replace(self):
+        os.mkdir(self.filename)
+
+        with self.assertRaises(OSError):
+            api.write_json_file(self.filename, {'a': 1})
+
+        self.assertEqual(os.listdir(self.temp_dir), ['config.json'])
+
+
+class LockTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='inkbot-test-')
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.runner = RecordingRunner()
+        self.fleet = Fleet(osp.join(self.temp_dir, 'darknode'), self.runner)
+
+        for name in ['a', 'b', 'c']:
+            os.makedirs(osp.join(self.fleet.darknodes_dir, name))
+
+    def hold_lock(self, name):
+        # Hold node lock name in another thread until the returned event is set
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with self.fleet.node_lock(name):
+                acquired.set()
+                release.wait(10)
+
+        thread = threading.Thread(target=hold, daemon=True)
+        thread.start()
+        self.assertTrue(acquired.wait(5))
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        return release
+
+    def test_reentrant(self):
+        with self.fleet.tree_lock(exclusive=True):
+            with self.fleet.tree_lock(), self.fleet.node_lock('a'), self.fleet.node_lock('a'):
+                pass
+
+    def test_no_upgrade(self):
+        with self.fleet.tree_lock():
+            with self.assertRaisesRegex(InkbotError, "Can't upgrade"):
+                with self.fleet.tree_lock(exclusive=True):
+                    pass
+
+        with self.fleet.node_lock('a', exclusive=False):
+            with self.assertRaisesRegex(InkbotError, "Can't upgrade"):
+                with self.fleet.node_lock('a'):
+                    pass
+
+    def test_snapshot_waits_for_locked_node(self):
+        release = self.hold_lock('b')
+        backup_dir = osp.join(self.temp_dir, 'backup')
+        snapshot = threading.Thread(target=Backup(self.fleet).snapshot, args=(backup_dir,), daemon=True)
+        snapshot.start()
+        self.addCleanup(snapshot.join, 10)
+
+        def node_backup_dir(name):
+            return osp.join(backup_dir, 'darknodes', name)
+
+        # Darknodes before b are copied, b waits for its lock
+        self.assertTrue(wait_for(lambda: self.runner.synced(node_backup_dir('a'))))
+        self.assertTrue(self.runner.synced(backup_dir))
+        time.sleep(0.2)
+        self.assertFalse(self.runner.synced(node_backup_dir('b')))
+        self.assertTrue(snapshot.is_alive())
+
+        # Other darknodes can still be locked meanwhile
+        with self.fleet.node_lock('c'):
+            pass
+
+        release.set()
+        snapshot.join(5)
+        self.assertFalse(snapshot.is_alive())
+        self.assertTrue(self.runner.synced(node_backup_dir('b')))
+        self.assertTrue(self.runner.synced(node_backup_dir('c')))
+
+    def test_restore_waits_for_shared_lock(self):
+        release = self.hold_lock('a')
+        locked = threading.Event()
+
+        def exclusive():
+            with self.fleet.tree_lock(exclusive=True):
+                locked.set()
+
+        thread = threading.Thread(target=exclusive, daemon=True)
+        thread.start()
+        self.assertFalse(locked.wait(0.2))
+        release.set()
+        self.assertTrue(locked.wait(5))
+        thread.join(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
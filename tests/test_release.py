@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from inkbot import api
+from inkbot.api import Fleet, ReleaseError
+from os import path as osp
+from unittest import mock
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ReleaseServer(object):
+    '''
+    Local stand-in for the release server, serving files from a temp dir
+    '''
+    def __init__(self):
+        self.root = tempfile.mkdtemp(prefix='inkbot-releases-')
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=self.root))
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def write(self, name, data):
+        filename = osp.join(self.root, name)
+        os.makedirs(osp.dirname(filename), exist_ok=True)
+
+        with open(filename, 'wb') as fobj:
+            fobj.write(data)
+
+    def publish(self, version, checksum=None, files=None):
+        files = dict(files or {}, **{'bin/darknode': '#!/bin/sh\necho darknode version {}\n'.format(version)})
+        archive = release_archive(files)
+        self.write('{}/darknode-cli.tgz'.format(version), archive)
+        self.write('{}/darknode-cli.tgz.sha256'.format(version), '{}  darknode-cli.tgz\n'.format(
+            checksum or hashlib.sha256(archive).hexdigest()).encode())
+        self.write('latest', version.encode())
+
+
+def release_archive(files):
+    # files maps names to the content of executable scripts
+    buf = io.BytesIO()
+
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for name, script in sorted(files.items()):
+            data = script.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(data))
+
+    return buf.getvalue()
+
+
+class MirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ReleaseServer()
+        self.addCleanup(self.server.close)
+        self.darknode_dir = tempfile.mkdtemp(prefix='inkbot-test-')
+        self.addCleanup(shutil.rmtree, self.darknode_dir)
+        patcher = mock.patch.dict(os.environ, {'INKBOT_RELEASE_URL': self.server.url})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fleet = Fleet(self.darknode_dir)
+
+    def test_install_pins_release(self):
+        self.server.publish('1.0.0')
+        self.assertEqual(self.fleet.install_darknode_cli(), '1.0.0')
+        self.assertTrue(osp.exists(self.fleet.bin()))
+        self.assertEqual(self.fleet.pinned_release(), {
+            'version': '1.0.0',
+            'sha256': api.file_sha256(self.fleet.release_archive('1.0.0')),
+        })
+        self.assertIsNone(self.fleet.install_darknode_cli())
+
+    def test_update(self):
+        self.server.publish('1.0.0')
+        self.fleet.install_darknode_cli()
+        self.server.publish('1.1.0')
+        self.assertEqual(self.fleet.install_darknode_cli(update=True), '1.1.0')
+        self.assertEqual(self.fleet.pinned_release()['version'], '1.1.0')
+
+    def test_checksum_mismatch(self):
+        self.server.publish('1.0.0', checksum='0' * 64)
+
+        with self.assertRaisesRegex(ReleaseError, 'Checksum mismatch'):
+            self.fleet.prefetch_darknode_cli()
+
+        self.assertEqual(os.listdir(self.fleet.release_cache_dir), [])
+
+    def test_pinned_checksum_mismatch(self):
+        self.server.publish('1.0.0')
+        self.fleet.install_darknode_cli()
+        # Republished with different content and a matching checksum
+        archive = release_archive({'bin/darknode': '#!/bin/sh\necho evil 1.0.0\n'})
+        self.server.write('1.0.0/darknode-cli.tgz', archive)
+        self.server.write('1.0.0/darknode-cli.tgz.sha256', hashlib.sha256(archive).hexdigest().encode())
+
+        with self.assertRaisesRegex(ReleaseError, 'Checksum mismatch'):
+            self.fleet.prefetch_darknode_cli('1.0.0')
+
+    def test_pinned_release_not_cached(self):
+        self.server.publish('1.0.0')
+        self.fleet.install_darknode_cli()
+        os.unlink(self.fleet.release_archive('1.0.0'))
+        shutil.rmtree(self.fleet.bin_dir)
+        self.server.publish('2.0.0')
+
+        with self.assertRaisesRegex(ReleaseError, 'pinned but not cached'):
+            self.fleet.install_darknode_cli()
+
+        self.assertFalse(osp.exists(self.fleet.bin_dir))
+        self.assertEqual(self.fleet.prefetch_darknode_cli('1.0.0'), '1.0.0')
+        self.assertEqual(self.fleet.install_darknode_cli(), '1.0.0')
+
+    def test_missing_checksum_file(self):
+        self.server.publish('1.0.0')
+        self.fleet.prefetch_darknode_cli()
+        os.unlink(self.fleet.release_archive('1.0.0') + '.sha256')
+
+        with self.assertRaisesRegex(ReleaseError, 'Checksum of .* not found'):
+            self.fleet.install_darknode_cli(version='1.0.0')
+
+    def test_release_not_found(self):
+        self.server.publish('1.0.0')
+
+        with self.assertRaisesRegex(ReleaseError, 'Failed to download'):
+            self.fleet.prefetch_darknode_cli('9.9.9')
+
+
+@unittest.skipIf(shutil.which('curl') is None, 'curl is not installed')
+class InstallScriptTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ReleaseServer()
+        self.addCleanup(self.server.close)
+        self.darknode_dir = tempfile.mkdtemp(prefix='inkbot-test-')
+        self.addCleanup(shutil.rmtree, self.darknode_dir)
+        environ = dict(os.environ)
+        environ.pop('INKBOT_RELEASE_URL', None)
+
+        for patcher in [mock.patch.dict(os.environ, environ, clear=True),
+                        mock.patch.object(api, 'install_script_url', self.server.url + '/install.sh')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.fleet = Fleet(self.darknode_dir)
+
+    def publish(self, version):
+        self.server.write('install.sh', (
+            'mkdir -p "$HOME/.darknode/bin"\n'
+            'printf "#!/bin/sh\\necho darknode version {}\\n" > "$HOME/.darknode/bin/darknode"\n'
+            'chmod +x "$HOME/.darknode/bin/darknode"\n').format(version).encode())
+
+    def test_checksum_pinned_on_first_install(self):
+        self.publish('1.0.0')
+        self.assertEqual(self.fleet.install_darknode_cli(), '1.0.0')
+        checksum = self.fleet.pinned_release()['sha256']
+        os.unlink(self.fleet.release_archive('1.0.0'))
+        # Repacked reproducibly, so the pinned checksum still matches
+        self.assertEqual(self.fleet.prefetch_darknode_cli('1.0.0'), '1.0.0')
+        self.assertEqual(api.file_sha256(self.fleet.release_archive('1.0.0')), checksum)
+
+    def test_only_latest(self):
+        self.publish('2.0.0')
+
+        with self.assertRaisesRegex(ReleaseError, 'only installs the latest'):
+            self.fleet.prefetch_darknode_cli('1.0.0')
+
+
+if __name__ == '__main__':
+    unittest.main()